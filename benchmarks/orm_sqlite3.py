@@ -0,0 +1,63 @@
+"""
+Compare the ORM with the raw sqlite3 on the rules table of 100000 rules: python -m benchmarks.orm_sqlite3
+"""
+import asyncio
+import time
+from typing import Any
+
+from database.orm_sqlite3 import Database
+
+
+async def benchmark(count: int = 100_000):
+    db = Database()
+    await db.create_tables()
+    rt = db.get_rules_table()
+    rules = [{"recip_id": -1000 - index % 50, "donor_id": -2000 - index % 500, "filter": '*', "format": 'm',
+              "title": f"rule {index}", "status": 'active', "user_id": index % 10} for index in range(count)]
+    insert_str, _ = rt.build_insert_query({})
+
+    def raw_insert():
+        with rt.connection:
+            rt.cursor.execute("DELETE FROM rules;")
+            rt.cursor.executemany(insert_str, ([rule.get(column) or '' for column in rt.__slots__[:-1]]
+                                               for rule in rules))
+
+    def raw_load() -> list[Any]:
+        return [rt.model_obj._make(row) for row in rt.cursor.execute("SELECT * FROM rules;").fetchall()]
+
+    def raw_donor_load() -> list[Any]:
+        return [[rt.model_obj._make(row) for row in rt.cursor.execute(
+            "SELECT * FROM rules WHERE donor_id=(?) AND status=(?);", [-2000 - index, 'active']).fetchall()]
+            for index in range(500)]
+
+    def raw_update():
+        for uid in range(1, 10_001):
+            with rt.connection:
+                rt.cursor.execute("UPDATE rules SET status=(?) WHERE uid=(?);", ['paused', uid])
+                rt.connection.commit()
+
+    async def orm_donor_load() -> list[Any]:
+        return [await rt.get_rules(where={"donor_id": -2000 - index, "status": 'active'}) for index in range(500)]
+
+    async def orm_update():
+        await db.db.run(lambda: [rt._update({"status": 'paused'}, {"uid": uid}) for uid in range(1, 10_001)])
+
+    cases = [
+        (f"replace {count} rules", lambda: db.db.run(raw_insert), lambda: rt.replace_rules(rules)),
+        (f"load {count} rules", lambda: db.db.run(raw_load), lambda: rt.get_rules()),
+        ("load the rules of 500 donors", lambda: db.db.run(raw_donor_load), orm_donor_load),
+        ("update the status of 10000 rules", lambda: db.db.run(raw_update), orm_update),
+    ]
+    for title, raw, orm in cases:
+        started = time.perf_counter()
+        await raw()
+        raw_time = time.perf_counter() - started
+        started = time.perf_counter()
+        await orm()
+        orm_time = time.perf_counter() - started
+        print(f"{title}: raw {raw_time * 1000:.0f} ms, orm {orm_time * 1000:.0f} ms ({orm_time / raw_time:.2f}x)")
+    await db.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark())
@@ -0,0 +1,55 @@
+"""
+Compare matching of the wildcard patterns of many rules by one WordIndex scan with the younotyou calls made for
+each rule, and check that both give the same results: python -m benchmarks.word_index
+"""
+import random
+import time
+
+from younotyou import younotyou as flt
+
+from shared.filter_by_parameters import MessageText
+from shared.word_index import WordIndex, TOKENS
+
+
+def benchmark_wildcards(messages: int = 2000, rules: int = 200, seed: int = 0) -> bool:
+    rnd = random.Random(seed)
+    syllables = ["pat", "tern", "str", "ing", "list", "tree", "ev", "ery", "any", "thing", "lo", "rem"]
+    words = [''.join(rnd.choice(syllables) for _ in range(rnd.randint(1, 3))) for _ in range(500)]
+    texts = [' '.join(rnd.choice(words) for _ in range(rnd.randint(5, 60))) for _ in range(messages)]
+    rule_patterns = []
+    for _ in range(rules):
+        patterns = []
+        for _ in range(rnd.randint(1, 4)):
+            word = rnd.choice(words)
+            patterns.append(rnd.choice([f'*{word}', f'{word}*', f'*{word}*', f'{word[:-1]}?']))
+        rule_patterns.append(patterns)
+
+    started = time.perf_counter()
+    expected = []
+    for text in texts:
+        strings = text.split()
+        expected.append([len(flt(strings, patterns)) > 0 for patterns in rule_patterns])
+    flt_time = time.perf_counter() - started
+
+    index = WordIndex()
+    rule_ids = [frozenset(index.add(pattern, TOKENS) for pattern in patterns) for patterns in rule_patterns]
+    started = time.perf_counter()
+    index.compile()
+    compile_time = time.perf_counter() - started
+    started = time.perf_counter()
+    results = []
+    for text in texts:
+        hits = index.scan(MessageText(text))
+        results.append([not ids.isdisjoint(hits) for ids in rule_ids])
+    index_time = time.perf_counter() - started
+
+    print(f"{messages} messages x {rules} rules with wildcard patterns")
+    print(f"younotyou per rule: {flt_time:.3f}s, {messages / flt_time:.0f} msg/s")
+    print(f"WordIndex.compile:  {compile_time:.3f}s, once per reload")
+    print(f"WordIndex.scan:     {index_time:.3f}s, {messages / index_time:.0f} msg/s")
+    print(f"results are {'the same' if results == expected else 'DIFFERENT'}")
+    return results == expected
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if benchmark_wildcards() else 1)
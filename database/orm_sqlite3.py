@@ -1,9 +1,13 @@
 import asyncio
+import functools
 import sqlite3
+import threading
+import time
 from abc import abstractmethod, ABCMeta
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from sqlite3 import Connection, Cursor
-from typing import Any
+from typing import Any, Callable
 
 
 class QueryException(Exception):
@@ -12,13 +16,89 @@ class QueryException(Exception):
         self.msgfmt = message
 
 
+class DbExecutor:
+    """
+    Runs the queries out of the event loop thread: the async methods of the tables wait for the worker threads
+    running the queries, so the message handling goes on during the database work. Each worker thread has its own
+    connection to the database, opened on its first query in WAL mode, so the readers don't wait for the writer.
+    """
+    # WAL journal, the commit doesn't fsync the database file (safe with WAL), the writer waits for the lock instead
+    # of failing at once, the temporary tables in memory and a 16 MB page cache
+    PRAGMAS = ("PRAGMA journal_mode=WAL;", "PRAGMA synchronous=NORMAL;", "PRAGMA busy_timeout=5000;",
+               "PRAGMA temp_store=MEMORY;", "PRAGMA cache_size=-16000;")
+
+    def __init__(self, db_file: str = '', *, workers: int = 1):
+        """
+        :param db_file: path of the database file, the database is kept in memory if empty
+        :param workers: count of the worker threads, each with its own connection
+        """
+        self.db_file = db_file if len(db_file) else ":memory:"
+        # each connection to ":memory:" opens a database of its own
+        if self.db_file == ":memory:":
+            workers = 1
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="db")
+        self._local = threading.local()
+        self._connections: list[Connection] = []
+        self._lock = threading.Lock()
+
+    def connection(self) -> Connection:
+        """
+        :return: the connection of the calling thread
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_file, check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                connection.execute(pragma)
+            self._local.connection = connection
+            self._local.cursor = connection.cursor()
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def cursor(self) -> Cursor:
+        """
+        :return: the cursor of the connection of the calling thread
+        """
+        self.connection()
+        return self._local.cursor
+
+    async def run(self, function: Callable, *args, **kwargs) -> Any:
+        """
+        Run the function by a worker thread and wait for its result
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                functools.partial(function, *args, **kwargs))
+
+    def close(self):
+        """
+        Wait for the queries already started and close all the connections
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+
+def db_method(method: Callable) -> Callable:
+    """
+    Make the async method of the table from the sync method, the sync method is run by a worker thread of the
+    DbExecutor of the table. The sync methods call each other directly, they are run by the same thread.
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self.db.run(method, self, *args, **kwargs)
+
+    return wrapper
+
+
 class BaseTable(object, metaclass=ABCMeta):
-    __slots__ = ("__table_name__", "connection", "cursor", "model_obj")
+    __slots__ = ("__table_name__", "db", "model_obj", "row_factory", "_queries")
 
-    def __init__(self, *, table_name: str = '', connection: Connection = None, cursor: Cursor = None):
+    def __init__(self, *, table_name: str = '', db: DbExecutor = None):
         self.__table_name__ = table_name
-        self.connection = connection
-        self.cursor = cursor
+        self.db = db
         fields_arr = []
         defaults_arr = []
         is_rename = False
@@ -28,13 +108,51 @@ class BaseTable(object, metaclass=ABCMeta):
             fields_arr.append(field)
             defaults_arr.append('')
         self.model_obj = namedtuple(table_name, fields_arr, rename=is_rename, defaults=defaults_arr)
-
+        # the rows of the 'SELECT *' queries are made into model_obj by the cursor, see _select
+        make = self.model_obj._make
+        columns = [index for index, field in enumerate(self.__slots__) if not field.startswith('_')]
+        if len(columns) == len(self.__slots__):
+            self.row_factory = lambda cursor, row: make(row)
+        else:
+            self.row_factory = lambda cursor, row: make([row[index] for index in columns])
+        # the query shapes (SQL text and the columns of its parameters) by (operation, column names...)
+        self._queries: dict[tuple, Any] = {}
+
+    @property
+    def connection(self) -> Connection:
+        return self.db.connection()
+
+    @property
+    def cursor(self) -> Cursor:
+        return self.db.cursor()
 
     @abstractmethod
     async def create_table(self):
         ...
 
-    async def create(self, query):
+    def _query(self, key: tuple, build: Callable[[], Any]) -> Any:
+        """
+        :param key: (operation, column names...) of the query
+        :param build: function building the query shape, called once for the key
+        :return: the cached query shape
+        """
+        query = self._queries.get(key)
+        if query is None:
+            query = self._queries[key] = build()
+        return query
+
+    def _select(self, query_str: str, values: list or tuple = ()) -> list[Any]:
+        """
+        :return: the rows of the 'SELECT *' query as model_obj
+        """
+        cursor = self.connection.cursor()
+        cursor.row_factory = self.row_factory
+        try:
+            return cursor.execute(query_str, values).fetchall()
+        finally:
+            cursor.close()
+
+    def _create(self, query):
         try:
             with self.connection:
                 self.cursor.execute(query)
@@ -42,7 +160,7 @@ class BaseTable(object, metaclass=ABCMeta):
         except sqlite3.Error as er:
             raise er
 
-    async def add(self, data):
+    def _add(self, data):
         query_str, values_arr = self.build_insert_query(data)
         try:
             with self.connection:
@@ -50,7 +168,7 @@ class BaseTable(object, metaclass=ABCMeta):
         except sqlite3.Error as er:
             raise er
 
-    async def update(self, data, where):
+    def _update(self, data, where):
         query_str, values_arr = self.build_update_query(data, where=where)
         try:
             with self.connection:
@@ -59,7 +177,32 @@ class BaseTable(object, metaclass=ABCMeta):
         except sqlite3.Error:
             raise
 
-    async def delete(self, **kwargs):
+    def _replace_all(self, entries: list[dict[str, Any]]):
+        """
+        Replace all the records of the table by one transaction, the readers see either the old or the new records
+        """
+        query_str, _ = self.build_insert_query({})
+        with self.connection:
+            self.cursor.execute(f"DELETE FROM {self.__table_name__};")
+            self.cursor.executemany(query_str, (self.build_insert_query(data)[1] for data in entries))
+
+    @db_method
+    def create(self, query):
+        self._create(query)
+
+    @db_method
+    def add(self, data):
+        self._add(data)
+
+    @db_method
+    def update(self, data, where):
+        self._update(data, where)
+
+    @db_method
+    def delete(self, **kwargs):
+        self._delete(**kwargs)
+
+    def _delete(self, **kwargs):
         """
         Delete record(s) from table
         :param kwargs: may contain one or more parameters. In case of 2 or more parameters you must specify logical
@@ -89,7 +232,8 @@ class BaseTable(object, metaclass=ABCMeta):
             self.cursor.execute(f"DELETE FROM {self.__table_name__} {where_str}", where_args)
             self.connection.commit()
 
-    async def count(self, **where) -> int:
+    @db_method
+    def count(self, **where) -> int:
         """
         Count record(s) in table
         :param where: may contain one or more parameters. In case of 2 or more parameters you must specify logical
@@ -141,85 +285,74 @@ class BaseTable(object, metaclass=ABCMeta):
             order_by_str += ";"
         return order_by_str
 
+    @staticmethod
+    def _order_key(order_by: str or list[str] or None) -> tuple:
+        if not order_by:
+            return ()
+        return (order_by, ) if isinstance(order_by, str) else tuple(order_by)
+
     def _build_order_by_str(self, order_by: str or list[str] or None = None) -> str:
-        order_by_str = ''
-        if order_by:
-            order_by = list([order_by]) if isinstance(order_by, str) else order_by
-            order_by_str += " ORDER BY "
-            for order in order_by:
-                # don't order by unknown columns name
-                if order not in self.__slots__:
-                    continue
-                order_by_str += order
-                if len(order_by) > 1:
-                    order_by_str += ", "
-            order_by_str = order_by_str.removesuffix(', ')
-        return order_by_str
+        def build() -> str:
+            # don't order by unknown columns name
+            columns = [order for order in order_key if order in self.__slots__]
+            return f" ORDER BY {', '.join(columns)}" if columns else ''
+
+        order_key = self._order_key(order_by)
+        return self._query(("order_by", ) + order_key, build) if order_key else ''
 
     def _build_where_str(self, where: dict[str, Any] or None = None) -> tuple[str, list]:
-        values = []
-        where_str = ""
-        if where:
-            where_str = " WHERE "
-            for key in where:
-                # add to query only known parameters
-                if key in self.__slots__:
-                    where_str += f"{key}=(?)"
-                    values.append(where.get(key))
-                if len(where) > 1:
-                    where_str += " AND "
-            where_str = where_str.removesuffix(f" AND ")
-        return where_str, values
+        def build() -> tuple[str, tuple]:
+            # add to query only known parameters
+            columns = tuple(key for key in where if key in self.__slots__)
+            return (f" WHERE {' AND '.join(f'{key}=(?)' for key in columns)}" if columns else ''), columns
+
+        if not where:
+            return "", []
+        where_str, columns = self._query(("where", ) + tuple(where), build)
+        return where_str, [where[key] for key in columns]
 
     def build_insert_query(self, data) -> tuple[str, list]:
-        columns = ""
-        values = ""
-        values_arr = []
-        for index, column_name in enumerate(self.__slots__):
-            attr = self.__getattribute__(column_name)
-            if type(attr) == int or type(attr) == float:
-                attr = str(attr).lower()
-            if attr == 'autoincrement':
-                continue
-            columns += f"{column_name}, "
-            values += f"?, "
-            values_arr.append(data.get(column_name) or self.__getattribute__(column_name))
-        columns = columns.rstrip(' ').removesuffix(',')
-        values = values.rstrip(' ').removesuffix(',')
-        query_str = f"INSERT INTO {self.__table_name__} ({columns}) VALUES ({values})"
+        def build() -> tuple[str, tuple, tuple]:
+            columns = []
+            defaults = []
+            for column_name in self.__slots__:
+                attr = self.__getattribute__(column_name)
+                if type(attr) == int or type(attr) == float:
+                    attr = str(attr).lower()
+                if attr == 'autoincrement':
+                    continue
+                columns.append(column_name)
+                defaults.append(self.__getattribute__(column_name))
+            query_str = f"INSERT INTO {self.__table_name__} ({', '.join(columns)}) " \
+                        f"VALUES ({', '.join('?' * len(columns))})"
+            return query_str, tuple(columns), tuple(defaults)
 
-        return query_str, values_arr
+        query_str, columns, defaults = self._query(("insert", ), build)
+        return query_str, [data.get(column_name) or default for column_name, default in zip(columns, defaults)]
 
     def build_select_query(self,
                            where: dict[str, Any] or None = None,
                            order_by: str or list[str] or None = None) -> tuple[str, list]:
-        select_str = f"SELECT * FROM {self.__table_name__}"
-        order_by_str = self._build_order_by_str(order_by)
         where_str, values = self._build_where_str(where)
-
-        select_str += f"{where_str}{order_by_str};"
+        select_str = self._query(("select", where_str) + self._order_key(order_by),
+                                 lambda: f"SELECT * FROM {self.__table_name__}{where_str}"
+                                         f"{self._build_order_by_str(order_by)};")
         return select_str, values
 
     def build_update_query(self, data, where: dict[str, Any] = None) -> tuple[str, list]:
         #  f"UPDATE users SET role=(?), company=(?), company_number=(?) WHERE userid=(?)"
-        columns = ""
-        values_arr = []
-        for column_name in data:
+        def build() -> tuple[str, tuple]:
             # add to query only known parameters!
-            if column_name in self.__slots__:
-                columns += f"{column_name}=(?), "
-                values_arr.append(data.get(column_name))
-        columns = columns.rstrip(' ').removesuffix(',')
-        query_str = f"UPDATE {self.__table_name__} SET {columns}"
-        where_str = ""
+            columns = tuple(column_name for column_name in data if column_name in self.__slots__)
+            query_str = f"UPDATE {self.__table_name__} SET {', '.join(f'{column}=(?)' for column in columns)}"
+            if where:
+                query_str += f" WHERE {' AND '.join(f'{key}=(?)' for key in where)}"
+            return query_str, columns
+
+        query_str, columns = self._query(("update", tuple(data), tuple(where or ())), build)
+        values_arr = [data[column_name] for column_name in columns]
         if where:
-            where_str = " WHERE "
-            for key in where:
-                where_str += f"{key}=(?)"
-                values_arr.append(where.get(key))
-                if len(where) > 1:
-                    where_str += " AND "
-        query_str += where_str
+            values_arr.extend(where.values())
         return query_str, values_arr
 
     def convert_to_data(self, raw_data) -> dict[str, Any]:
@@ -232,42 +365,39 @@ class BaseTable(object, metaclass=ABCMeta):
         return data
 
     def convert_to_model_obj(self, raw_data) -> Any:
-        values_arr = []
-        for index, col_name in enumerate(self.__slots__):
-            if col_name.startswith('_'):
-                continue
-            values_arr.append(raw_data[index])
-
-        return self.model_obj._make(values_arr)
+        return self.row_factory(None, raw_data)
 
 
 class ImageTable(BaseTable):
     __slots__ = ("file_id", "path")
 
-    def __init__(self, connection: Connection, cursor: Cursor):
-        super().__init__(table_name="image", connection=connection, cursor=cursor)
+    def __init__(self, db: DbExecutor):
+        super().__init__(table_name="image", db=db)
         self.file_id: str = ''
         self.path: str = ''
 
-    async def create_table(self):
+    @db_method
+    def create_table(self):
         create_table_query = f"CREATE TABLE IF NOT EXISTS {self.__table_name__}(" \
                              f"{self.__slots__[0]} TEXT," \
                              f"{self.__slots__[1]} TEXT)"
-        await self.create(create_table_query)
+        self._create(create_table_query)
 
-    async def add_image(self, data: dict[str, str]):
+    @db_method
+    def add_image(self, data: dict[str, str]):
         try:
-            await self.add(data)
+            self._add(data)
         except sqlite3.Error as er:
             print("add_image error:", er)
 
-    async def get_image(self, path: str) -> Any:
+    @db_method
+    def get_image(self, path: str) -> Any:
         image = None
         try:
             with self.connection:
-                row = self.cursor.execute(f"SELECT * FROM {self.__table_name__} WHERE path=(?);", [path]).fetchone()
-                if row:
-                    image = self.convert_to_model_obj(row)
+                images = self._select(f"SELECT * FROM {self.__table_name__} WHERE path=(?) LIMIT 1;", [path])
+                if images:
+                    image = images[0]
         except sqlite3.Error as er:
             print("get_image error:", er)
         return image
@@ -278,8 +408,8 @@ class RulesTable(BaseTable):
                  "sender_id", "filter", "black_list", "and_list", "or_list", "format", "title", "status", "user_id",
                  "uid")
 
-    def __init__(self, connection: Connection, cursor: Cursor):
-        super().__init__(table_name="rules", connection=connection, cursor=cursor)
+    def __init__(self, db: DbExecutor):
+        super().__init__(table_name="rules", db=db)
         self.recip_name: str = ''
         self.recip_id: int = 0
         self.donor_name: str = ''
@@ -313,7 +443,8 @@ class RulesTable(BaseTable):
                f"Format: {rule.format}\n" \
                f"**Status: {rule.status}**"
 
-    async def create_table(self):
+    @db_method
+    def create_table(self):
         create_table_query = f"CREATE TABLE IF NOT EXISTS {self.__table_name__}(" \
                              f"{self.__slots__[0]} TEXT," \
                              f"{self.__slots__[1]} INT," \
@@ -332,46 +463,65 @@ class RulesTable(BaseTable):
                              f"{self.__slots__[14]} TEXT," \
                              f"{self.__slots__[15]} INT," \
                              f"{self.__slots__[16]} INTEGER PRIMARY KEY AUTOINCREMENT)"
-        await self.create(create_table_query)
+        self._create(create_table_query)
 
-    async def add_rule(self, data: dict[str, Any]):
+    @db_method
+    def add_rule(self, data: dict[str, Any]):
         try:
-            await self.add(data)
+            self._add(data)
         except sqlite3.Error as er:
             print("add_rule error:", er)
 
-    async def get_rules(self, where: dict[str, Any] or None = None,
-                        order_by: str or list[str] or None = None) -> list[Any]:
+    @db_method
+    def get_rules(self, where: dict[str, Any] or None = None,
+                  order_by: str or list[str] or None = None, *, strict: bool = False) -> list[Any]:
+        """
+        :param strict: raise the error of the database instead of returning no rules
+        """
         rules = []
         query_str, values = self.build_select_query(where=where, order_by=order_by)
         try:
             with self.connection:
-                rows = self.cursor.execute(query_str, values).fetchall()
-                for row in rows:
-                    obj = self.convert_to_model_obj(row)
-                    rules.append(obj)
+                rules = self._select(query_str, values)
         except sqlite3.Error as er:
+            if strict:
+                raise
             print("get_rules error:", er)
         return rules
 
-    async def update_rule(self, uid: int, data: dict[str, Any]):
+    @db_method
+    def update_rule(self, uid: int, data: dict[str, Any]):
         try:
-            await self.update(data, where={"uid": uid})
+            self._update(data, where={"uid": uid})
         except sqlite3.Error as er:
             print("update_rule error:", er)
 
-    async def delete_all_rules(self):
+    @db_method
+    def delete_all_rules(self):
         with self.connection:
             self.cursor.execute(f"DELETE FROM {self.__table_name__};")
             self.connection.commit()
 
+    @db_method
+    def replace_rules(self, rules: list[dict[str, Any]]) -> bool:
+        """
+        Replace all the rules by the given ones in one transaction
+        :return: False if the rules weren't replaced, the previous rules are kept then
+        """
+        try:
+            self._replace_all(rules)
+        except sqlite3.Error as er:
+            print("replace_rules error:", er)
+            return False
+        return True
+
 
 class BleepTable(BaseTable):
     __slots__ = ("donor_name", "donor_id", "black_list", "status", "bleep_symbol", "bleep_actions",
                  "action_format", "uid")
 
-    def __init__(self, connection: Connection, cursor: Cursor):
-        super().__init__(table_name="bleeping_rules", connection=connection, cursor=cursor)
+    def __init__(self, db: DbExecutor):
+        super().__init__(table_name="bleeping_rules", db=db)
         self.donor_name: str = ''
         self.donor_id: int = 0
         self.black_list: str = ''
@@ -390,7 +540,8 @@ class BleepTable(BaseTable):
                f"Black list: {rule.black_list}\n" \
                f"**Status: {rule.status}**"
 
-    async def create_table(self):
+    @db_method
+    def create_table(self):
         create_table_query = f"CREATE TABLE IF NOT EXISTS {self.__table_name__}(" \
                              f"{self.__slots__[0]} TEXT," \
                              f"{self.__slots__[1]} INT," \
@@ -400,52 +551,340 @@ class BleepTable(BaseTable):
                              f"{self.__slots__[5]} TEXT," \
                              f"{self.__slots__[6]} TEXT," \
                              f"{self.__slots__[7]} INTEGER PRIMARY KEY AUTOINCREMENT)"
-        await self.create(create_table_query)
+        self._create(create_table_query)
 
-    async def add_rule(self, data: dict[str, Any]):
+    @db_method
+    def add_rule(self, data: dict[str, Any]):
         try:
-            await self.add(data)
+            self._add(data)
         except sqlite3.Error as er:
             print("add_bleeping_rule error:", er)
 
-    async def get_rules(self, where: dict[str, Any] or None = None,
-                        order_by: str or list[str] or None = None) -> list[Any]:
+    @db_method
+    def get_rules(self, where: dict[str, Any] or None = None,
+                  order_by: str or list[str] or None = None, *, strict: bool = False) -> list[Any]:
+        """
+        :param strict: raise the error of the database instead of returning no rules
+        """
         rules = []
         query_str, values = self.build_select_query(where=where, order_by=order_by)
         try:
             with self.connection:
-                rows = self.cursor.execute(query_str, values).fetchall()
-                for row in rows:
-                    obj = self.convert_to_model_obj(row)
-                    rules.append(obj)
+                rules = self._select(query_str, values)
         except sqlite3.Error as er:
+            if strict:
+                raise
             print("get_bleeping_rules error:", er)
         return rules
 
-    async def update_rule(self, uid: int, data: dict[str, Any]):
+    @db_method
+    def update_rule(self, uid: int, data: dict[str, Any]):
         try:
-            await self.update(data, where={"uid": uid})
+            self._update(data, where={"uid": uid})
         except sqlite3.Error as er:
             print("update_bleeping_rule error:", er)
 
-    async def delete_all_rules(self):
+    @db_method
+    def delete_all_rules(self):
         with self.connection:
             self.cursor.execute(f"DELETE FROM {self.__table_name__};")
             self.connection.commit()
 
+    @db_method
+    def replace_rules(self, rules: list[dict[str, Any]]) -> bool:
+        """
+        Replace all the rules by the given ones in one transaction
+        :return: False if the rules weren't replaced, the previous rules are kept then
+        """
+        try:
+            self._replace_all(rules)
+        except sqlite3.Error as er:
+            print("replace_bleeping_rules error:", er)
+            return False
+        return True
+
+
+class OutboxTable(BaseTable):
+    __slots__ = ("donor_id", "msg_id", "recip_id", "message_ids", "kind", "header", "status", "attempts", "created",
+                 "uid")
+
+    # statuses of the deliveries
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    def __init__(self, db: DbExecutor):
+        super().__init__(table_name="outbox", db=db)
+        self.donor_id: int = 0
+        self.msg_id: int = 0            # id of the message (of the caption message of the album) in the donor chat
+        self.recip_id: int = 0
+        self.message_ids: str = ''      # ',' separated ids of all the messages of the album
+        self.kind: str = ''             # 'copy', 'forward' or 'text', see postclient.deliver_entry
+        self.header: str = ''           # text added before the message, the whole text of the 'text' delivery
+        self.status: str = ''           # PENDING, SENT or FAILED
+        self.attempts: int = 0
+        self.created: float = 0
+        self.uid: int = 'autoincrement'
+
+    @db_method
+    def create_table(self):
+        # the same message is never delivered to the same recipient twice
+        create_table_query = f"CREATE TABLE IF NOT EXISTS {self.__table_name__}(" \
+                             f"{self.__slots__[0]} INT," \
+                             f"{self.__slots__[1]} INT," \
+                             f"{self.__slots__[2]} INT," \
+                             f"{self.__slots__[3]} TEXT," \
+                             f"{self.__slots__[4]} TEXT," \
+                             f"{self.__slots__[5]} TEXT," \
+                             f"{self.__slots__[6]} TEXT," \
+                             f"{self.__slots__[7]} INT," \
+                             f"{self.__slots__[8]} REAL," \
+                             f"{self.__slots__[9]} INTEGER PRIMARY KEY AUTOINCREMENT," \
+                             f"UNIQUE({self.__slots__[0]}, {self.__slots__[1]}, {self.__slots__[2]}))"
+        self._create(create_table_query)
+
+    @db_method
+    def add_entries(self, entries: list[dict[str, Any]]) -> list[bool]:
+        """
+        Add the deliveries by one transaction, the deliveries already added before are ignored
+        :param entries: the deliveries
+        :return: for each delivery, True if it was added, False if it's a duplicate
+        """
+        added = []
+        query_str, _ = self.build_insert_query({})
+        query_str = query_str.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
+        try:
+            with self.connection:
+                for data in entries:
+                    _, values_arr = self.build_insert_query(data)
+                    self.cursor.execute(query_str, values_arr)
+                    added.append(self.cursor.rowcount > 0)
+        except sqlite3.Error as er:
+            print("add_entries error:", er)
+            # the deliveries are sent anyway, only without the protection from the duplicates
+            added = [True] * len(entries)
+        return added
+
+    @db_method
+    def update_entries(self, sent: list[tuple[int, int, int]], failed: list[tuple[int, int, int]],
+                       max_attempts: int):
+        """
+        Set the statuses of the deliveries by one transaction
+        :param sent: (donor_id, msg_id, recip_id) of the sent deliveries
+        :param failed: (donor_id, msg_id, recip_id) of the failed attempts of the deliveries
+        :param max_attempts: the delivery failed this count of times gets the FAILED status
+        """
+        where_str = "WHERE donor_id=(?) AND msg_id=(?) AND recip_id=(?);"
+        try:
+            with self.connection:
+                if sent:
+                    self.cursor.executemany(f"UPDATE {self.__table_name__} SET status='{self.SENT}' {where_str}", sent)
+                if failed:
+                    self.cursor.executemany(f"UPDATE {self.__table_name__} SET attempts=attempts+1, "
+                                            f"status=CASE WHEN attempts+1>={int(max_attempts)} "
+                                            f"THEN '{self.FAILED}' ELSE status END {where_str}", failed)
+        except sqlite3.Error as er:
+            print("update_entries error:", er)
+
+    @db_method
+    def get_pending(self) -> list[Any]:
+        entries = []
+        try:
+            with self.connection:
+                entries = self._select(f"SELECT * FROM {self.__table_name__} WHERE status=(?) ORDER BY uid;",
+                                       [self.PENDING])
+        except sqlite3.Error as er:
+            print("get_pending error:", er)
+        return entries
+
+    @db_method
+    def expire_pending(self, created_before: float):
+        """
+        Set the FAILED status of the pending deliveries created before the given time
+        """
+        try:
+            with self.connection:
+                self.cursor.execute(f"UPDATE {self.__table_name__} SET status=(?) WHERE status=(?) AND created<(?);",
+                                    [self.FAILED, self.PENDING, created_before])
+        except sqlite3.Error as er:
+            print("expire_pending error:", er)
+
+    @db_method
+    def delete_done(self, created_before: float):
+        """
+        Delete the sent and failed deliveries created before the given time
+        """
+        try:
+            with self.connection:
+                self.cursor.execute(f"DELETE FROM {self.__table_name__} WHERE status!=(?) AND created<(?);",
+                                    [self.PENDING, created_before])
+        except sqlite3.Error as er:
+            print("delete_done error:", er)
+
+
+class CheckpointTable(BaseTable):
+    __slots__ = ("donor_id", "msg_id", "updated")
+
+    def __init__(self, db: DbExecutor):
+        super().__init__(table_name="checkpoints", db=db)
+        self.donor_id: int = 0
+        self.msg_id: int = 0        # id of the last processed message of the donor
+        self.updated: float = 0
+
+    @db_method
+    def create_table(self):
+        create_table_query = f"CREATE TABLE IF NOT EXISTS {self.__table_name__}(" \
+                             f"{self.__slots__[0]} INTEGER PRIMARY KEY," \
+                             f"{self.__slots__[1]} INT," \
+                             f"{self.__slots__[2]} REAL)"
+        self._create(create_table_query)
+
+    @db_method
+    def get_checkpoints(self) -> dict[int, int]:
+        """
+        :return: donor_id -> id of the last processed message
+        """
+        checkpoints = {}
+        try:
+            with self.connection:
+                for checkpoint in self._select(f"SELECT * FROM {self.__table_name__};"):
+                    checkpoints[checkpoint.donor_id] = checkpoint.msg_id
+        except sqlite3.Error as er:
+            print("get_checkpoints error:", er)
+        return checkpoints
+
+    @db_method
+    def put_checkpoints(self, checkpoints: list[tuple[int, int, float]]):
+        """
+        Store the checkpoints by one transaction
+        :param checkpoints: (donor_id, msg_id, updated) for each donor
+        """
+        try:
+            with self.connection:
+                self.cursor.executemany(f"INSERT OR REPLACE INTO {self.__table_name__} "
+                                        f"({', '.join(self.__slots__)}) VALUES (?, ?, ?);", checkpoints)
+        except sqlite3.Error as er:
+            print("put_checkpoints error:", er)
+
+
+class VersionTable(BaseTable):
+    __slots__ = ("name", "version")
+
+    # the tables the changes of which are counted, see the migration 2
+    RULES = 'rules'
+    BLEEPS = 'bleeping_rules'
+
+    def __init__(self, db: DbExecutor):
+        super().__init__(table_name="versions", db=db)
+        self.name: str = ''         # name of the counted table
+        self.version: int = 0       # increased by the triggers on each inserted, updated and deleted row of the table
+
+    @db_method
+    def create_table(self):
+        create_table_query = f"CREATE TABLE IF NOT EXISTS {self.__table_name__}(" \
+                             f"{self.__slots__[0]} TEXT PRIMARY KEY," \
+                             f"{self.__slots__[1]} INT)"
+        self._create(create_table_query)
+        with self.connection:
+            self.cursor.executemany(f"INSERT OR IGNORE INTO {self.__table_name__} ({', '.join(self.__slots__)}) "
+                                    f"VALUES (?, 0);", [[self.RULES], [self.BLEEPS]])
+
+    @db_method
+    def get_versions(self) -> dict[str, int]:
+        """
+        :return: name of the table -> its version
+        """
+        versions = {}
+        try:
+            with self.connection:
+                for version in self._select(f"SELECT * FROM {self.__table_name__};"):
+                    versions[version.name] = version.version
+        except sqlite3.Error as er:
+            print("get_versions error:", er)
+        return versions
+
+
+class MigrationTable(BaseTable):
+    __slots__ = ("version", "description", "applied")
+
+    def __init__(self, db: DbExecutor):
+        super().__init__(table_name="schema_version", db=db)
+        self.version: int = 0       # the schema version the migration step brought the database to
+        self.description: str = ''
+        self.applied: float = 0
+
+    @db_method
+    def create_table(self):
+        create_table_query = f"CREATE TABLE IF NOT EXISTS {self.__table_name__}(" \
+                             f"{self.__slots__[0]} INTEGER PRIMARY KEY," \
+                             f"{self.__slots__[1]} TEXT," \
+                             f"{self.__slots__[2]} REAL)"
+        self._create(create_table_query)
+
+    @db_method
+    def migrate(self, migrations: list[tuple[str, list[str] or Callable[[Cursor], Any]]]) -> list[int]:
+        """
+        Run the migration steps the database hasn't got yet, in their order. Each step is run by one transaction
+        together with the record of its version, so the failed step leaves the database at the previous version
+        :param migrations: (description, queries or function of the cursor) of each step, the step N brings the
+                           schema to the version N
+        :return: the versions applied now
+        """
+        applied = []
+        version = self.cursor.execute(f"SELECT MAX({self.__slots__[0]}) FROM {self.__table_name__};").fetchone()[0]
+        for version, (description, step) in enumerate(migrations[version or 0:], start=(version or 0) + 1):
+            with self.connection:
+                # sqlite3 doesn't start the transaction before DDL by itself
+                self.cursor.execute("BEGIN;")
+                if callable(step):
+                    step(self.cursor)
+                else:
+                    for query in step:
+                        self.cursor.execute(query)
+                self.cursor.execute(f"INSERT INTO {self.__table_name__} ({', '.join(self.__slots__)}) "
+                                    f"VALUES (?, ?, ?);", [version, description, time.time()])
+            applied.append(version)
+        return applied
+
+
+# The ordered steps upgrading the schema of the databases created by the previous versions, the step N brings the
+# schema to the version N. The tables are created by create_table with the newest schema before the steps are run,
+# so each step must keep such a table as is. Add the new steps to the end, never change the applied ones.
+MIGRATIONS: list[tuple[str, list[str] or Callable[[Cursor], Any]]] = [
+    ("index the rules and the bleeping rules by donor, recipient, status and tenant", [
+        "CREATE INDEX IF NOT EXISTS rules_donor_id ON rules(donor_id, status);",
+        "CREATE INDEX IF NOT EXISTS rules_recip_id ON rules(recip_id);",
+        "CREATE INDEX IF NOT EXISTS rules_status ON rules(status);",
+        "CREATE INDEX IF NOT EXISTS rules_user_id ON rules(user_id);",
+        "CREATE INDEX IF NOT EXISTS bleeping_rules_donor_id ON bleeping_rules(donor_id, status);",
+        "CREATE INDEX IF NOT EXISTS bleeping_rules_status ON bleeping_rules(status);",
+    ]),
+    ("count the changes of the rules and the bleeping rules", [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_{operation.lower()}_version AFTER {operation} ON {table} "
+        f"BEGIN UPDATE versions SET version=version+1 WHERE name='{table}'; END;"
+        for table in (VersionTable.RULES, VersionTable.BLEEPS) for operation in ("INSERT", "UPDATE", "DELETE")
+    ]),
+]
+
 
 class Database:
-    def __init__(self, *, db_file: str = ''):
-        self.connection = sqlite3.connect(db_file if len(db_file) else ":memory:")
-        self.cursor = self.connection.cursor()
+    def __init__(self, *, db_file: str = '', workers: int = 1):
+        """
+        :param db_file: path of the database file, the database is kept in memory if empty
+        :param workers: count of the threads running the queries, see DbExecutor
+        """
+        self.db = DbExecutor(db_file, workers=workers)
 
-        self.image_table: ImageTable = ImageTable(connection=self.connection, cursor=self.cursor)
-        self.rules_table: RulesTable = RulesTable(connection=self.connection, cursor=self.cursor)
-        self.bleep_table: BleepTable = BleepTable(connection=self.connection, cursor=self.cursor)
+        self.image_table: ImageTable = ImageTable(self.db)
+        self.rules_table: RulesTable = RulesTable(self.db)
+        self.bleep_table: BleepTable = BleepTable(self.db)
+        self.outbox_table: OutboxTable = OutboxTable(self.db)
+        self.checkpoint_table: CheckpointTable = CheckpointTable(self.db)
+        self.version_table: VersionTable = VersionTable(self.db)
+        self.migration_table: MigrationTable = MigrationTable(self.db)
 
     async def disconnect(self):
-        self.cursor.close()
-        self.connection.close()
+        await asyncio.get_running_loop().run_in_executor(None, self.db.close)
 
     def get_image_table(self) -> ImageTable:
         return self.image_table
@@ -456,10 +895,25 @@ class Database:
     def get_bleep_table(self) -> BleepTable:
         return self.bleep_table
 
+    def get_outbox_table(self) -> OutboxTable:
+        return self.outbox_table
+
+    def get_checkpoint_table(self) -> CheckpointTable:
+        return self.checkpoint_table
+
+    def get_version_table(self) -> VersionTable:
+        return self.version_table
+
     async def create_tables(self):
         await self.image_table.create_table()
         await self.rules_table.create_table()
         await self.bleep_table.create_table()
+        await self.outbox_table.create_table()
+        await self.checkpoint_table.create_table()
+        await self.version_table.create_table()
+        # upgrade the tables created by the previous versions in place
+        await self.migration_table.create_table()
+        await self.migration_table.migrate(MIGRATIONS)
 
 
 async def start():
@@ -469,4 +923,3 @@ async def start():
 
 if __name__ == '__main__':
     asyncio.run(start())
-
@@ -1,20 +1,28 @@
+import codecs
+import contextlib
 import csv
-import io
-import re
+import time
+from typing import Any, AsyncIterator
 
 from telethon import TelegramClient
 from telethon.tl.types import Document
 
 from database.orm_sqlite3 import Database
 from shared.config import Config
+from shared.send_scheduler import SendScheduler
 
+# the last row of the exported CSV, the rows after it are ignored by the import
+END_OF_RULES = "Insert filter definitions before this row"
+# count of the skipped rows listed in the report of the import
+MAX_REPORTED_ISSUES = 20
 
-async def cmd_export_rules(db: Database, tg_client: TelegramClient):
-    await cmd_export_dialogs_rules(db, tg_client)
-    await cmd_export_bleep_rules(db, tg_client)
 
+async def cmd_export_rules(db: Database, scheduler: SendScheduler):
+    await cmd_export_dialogs_rules(db, scheduler)
+    await cmd_export_bleep_rules(db, scheduler)
 
-async def cmd_export_dialogs_rules(db: Database, tg_client: TelegramClient):
+
+async def cmd_export_dialogs_rules(db: Database, scheduler: SendScheduler):
     rules = await db.get_rules_table().get_rules()
     trash_bin_found = False
     rows = [
@@ -35,23 +43,21 @@ async def cmd_export_dialogs_rules(db: Database, tg_client: TelegramClient):
         rows.append(row)
     if not trash_bin_found:
         rows.append(['', 0, '', 0, '', '', '', 0, '', '', '', '', '', '__trash_bin__', '', Config.owner_id])
-    rows.append([
-        "Insert filter definitions before this row"
-    ])
+    rows.append([END_OF_RULES])
     try:
         rules_csv_file = "./rules.csv"
         with open(rules_csv_file, "w", encoding="utf8", newline="\n") as csv_file:
             writer = csv.writer(csv_file)
             writer.writerows(rows)
 
-        await tg_client.send_file(Config.app_channel_id, rules_csv_file, caption="Dialogs Rules definitions for Google Sheet")
+        await scheduler.send_file(Config.app_channel_id, rules_csv_file, caption="Dialogs Rules definitions for Google Sheet")
 
     except Exception as e:
-        await tg_client.send_message(Config.app_channel_id,
+        await scheduler.send_message(Config.app_channel_id,
                                      f"Error: {str(e)}\nContact the author: @MigoPhotos")
 
 
-async def cmd_export_bleep_rules(db: Database, tg_client: TelegramClient):
+async def cmd_export_bleep_rules(db: Database, scheduler: SendScheduler):
     rules = await db.get_bleep_table().get_rules()
     rows = [
         ["donor_name", "donor_id", "black_list", "status", "bleep_symbol", "bleep_actions", "action_format"]
@@ -62,125 +68,169 @@ async def cmd_export_bleep_rules(db: Database, tg_client: TelegramClient):
             rule.bleep_symbol, rule.bleep_actions, rule.action_format
         ]
         rows.append(row)
-    rows.append([
-        "Insert filter definitions before this row"
-    ])
+    rows.append([END_OF_RULES])
     try:
         rules_csv_file = "./bleeps.csv"
         with open(rules_csv_file, "w", encoding="utf8", newline="\n") as csv_file:
             writer = csv.writer(csv_file)
             writer.writerows(rows)
 
-        await tg_client.send_file(Config.app_channel_id, rules_csv_file, caption="Bleeps Rules definitions for Google Sheet")
+        await scheduler.send_file(Config.app_channel_id, rules_csv_file, caption="Bleeps Rules definitions for Google Sheet")
 
     except Exception as e:
-        await tg_client.send_message(Config.app_channel_id, f"Error: {str(e)}\nContact the author: @MigoPhotos")
-
-
-async def cmd_import_rules(db: Database, tg_client: TelegramClient, document: Document):
-    doc_data = await tg_client.download_file(document)
-    file = io.BytesIO(doc_data)
-    file.seek(0)
-    cat_list_csv = str(file.read(), encoding='utf-8')
-    cat_list = re.findall(r'.*\n', cat_list_csv)
-    cat_list.pop(0)
-    csv_data = csv.reader(cat_list)
-    # in case of empty file this var remains False, in another case it will equal count of columns in raw
-    is_known_csv = False
-
-    for first_row in csv_data:
-        is_known_csv = len(first_row)
-        break
+        await scheduler.send_message(Config.app_channel_id, f"Error: {str(e)}\nContact the author: @MigoPhotos")
+
+
+def parse_chat_id(chat_id: str) -> int:
+    """
+    :param chat_id: id of the chat from the CSV, the ids of the channels may be given without the leading '-'
+    """
+    if chat_id.startswith('100'):
+        return int(f'-{chat_id}')
+    return int(chat_id) if chat_id else 0
+
+
+def bleep_rule_data(row: list[str]) -> dict[str, Any]:
+    """
+    :param row: row of the CSV with the bleeping rule
+    :return: the bleeping rule for the BleepTable
+    :raise ValueError: if the row is invalid
+    """
+    donor_name, donor_id, black_list, status, bleep_symbol, bleep_actions, action_format = row
+    return {
+        "donor_name": donor_name,
+        "donor_id": parse_chat_id(donor_id),
+        "black_list": black_list,
+        "status": status,
+        "bleep_symbol": bleep_symbol,
+        "bleep_actions": bleep_actions,
+        "action_format": action_format
+    }
+
+
+def dialog_rule_data(row: list[str]) -> dict[str, Any]:
+    """
+    :param row: row of the CSV with the rule
+    :return: the rule for the RulesTable
+    :raise ValueError: if the row is invalid
+    """
+    recip_name, recip_id, donor_name, donor_id, sender_fname, sender_lname, sender_uname, \
+        sender_id, rule_filter, black_list, and_list, or_list, rule_format, title, status, user_id = row
+
+    if recip_name != '__trash_bin__':
+        if recip_id == '' or donor_id == '':
+            raise ValueError(f'Recipient ID {recip_id} or Donor ID {donor_id} cannot be empty! Skipped')
+
+        # Very Important check: the recipient channel link must not be the same as the donor channel link,
+        # excluding link to special channel, which can only be created by system administrator!
+        if recip_id == donor_id:
+            raise ValueError(f'Skipped rule: {recip_id} == {donor_id} - matching input and output channels are '
+                             f'prohibited!')
+
+    return {
+        "recip_name": recip_name,
+        "recip_id": parse_chat_id(recip_id),
+        "donor_name": donor_name,
+        "donor_id": parse_chat_id(donor_id),
+        "sender_fname": sender_fname,
+        "sender_lname": sender_lname,
+        "sender_uname": sender_uname,
+        "sender_id": int(sender_id) if sender_id.isdigit() else 0,
+        "filter": rule_filter,
+        "black_list": black_list,
+        "and_list": and_list,
+        "or_list": or_list,
+        "format": rule_format or 'M',
+        "title": title,
+        "status": status,
+        "user_id": int(user_id) if user_id.isdigit() else 0
+    }
+
+
+async def iter_csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[list[str]]:
+    """
+    Parse the CSV document while it's downloaded: the chunks are decoded incrementally and each record is parsed
+    as soon as its last line arrives
+    :param chunks: the document by parts
+    :return: the rows of the document
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    tail = ''
+    record = ''
+    quotes = 0
+    async for chunk in chunks:
+        lines = (tail + decoder.decode(chunk)).split('\n')
+        tail = lines.pop()
+        records = []
+        for line in lines:
+            record += line + '\n'
+            # the quoted fields may contain line breaks, the record goes on while its count of quotes is odd (the
+            # quotes inside the fields are doubled)
+            quotes += line.count('"')
+            if quotes % 2 == 0:
+                records.append(record)
+                record = ''
+                quotes = 0
+        for row in csv.reader(records):
+            yield row
+    record += tail + decoder.decode(b'', final=True)
+    if record.strip():
+        for row in csv.reader([record]):
+            yield row
+
+
+async def cmd_import_rules(db: Database, tg_client: TelegramClient, scheduler: SendScheduler, document: Document):
+    started = time.perf_counter()
+    table = None
+    to_data = None
+    columns = 0
+    rules = []
+    issues = []
+    row_count = 0
+    async with contextlib.aclosing(iter_csv_rows(tg_client.iter_download(document))) as rows:
+        async for row in rows:
+            row_count += 1
+            if table is None:
+                # the first row is the header, the count of its columns tells what rules the document contains
+                columns = len(row)
+                if columns == 7:        # BleepTable data
+                    table, to_data = db.get_bleep_table(), bleep_rule_data
+                elif columns == 16:     # RulesTable data
+                    table, to_data = db.get_rules_table(), dialog_rule_data
+                else:
+                    await scheduler.send_message(Config.app_channel_id,
+                                                 f'Unknown CSV format: {columns} columns in the header')
+                    return False
+                continue
+            if len(row) and row[0] == END_OF_RULES:
+                break
+            if not any(row):
+                continue
+            if len(row) != columns:
+                issues.append(f'row {row_count}: {len(row)} columns instead of {columns}. Skipped')
+                continue
+            try:
+                rules.append(to_data(row))
+            except ValueError as e:
+                issues.append(f'row {row_count}: {str(e)}')
+
+    if table is None:
+        return False
 
-    if not is_known_csv:
+    # the previous rules are replaced at once, the messages never see a half imported set of rules
+    if not await table.replace_rules(rules):
+        await scheduler.send_message(Config.app_channel_id, 'Error: the rules were not imported, the previous rules '
+                                                            'are kept\nContact the author: @MigoPhotos')
         return False
 
-    if is_known_csv == 7:   # BleepTable data
-        bt = db.get_bleep_table()
-        await bt.delete_all_rules()
-
-        new_rules_count = 0
-        csv_data = csv.reader(cat_list)
-        for row in csv_data:
-            data = {}
-            donor_name, donor_id, black_list, status, bleep_symbol, bleep_action, action_format = row
-
-            if donor_id.startswith('100'):
-                donor_id = int(f'-{donor_id}') if not donor_id.startswith('-') else int(donor_id)
-            else:
-                donor_id = int(donor_id) if donor_id else 0
-
-            data["donor_name"] = donor_name
-            data["donor_id"] = donor_id
-            data["black_list"] = black_list
-            data["status"] = status
-            data["bleep_symbol"] = bleep_symbol
-            data["bleep_action"] = bleep_action
-            data["action_format"] = action_format
-
-            await bt.add_rule(data)
-            new_rules_count += 1
-
-        await tg_client.send_message(Config.app_channel_id,
-                                     f'{new_rules_count} bleep rules was found and stored in database\n')
-    elif is_known_csv == 16:    # RulesTable data
-        rt = db.get_rules_table()
-        await rt.delete_all_rules()
-
-        new_rules_count = 0
-        csv_data = csv.reader(cat_list)
-        for row in csv_data:
-            data = {}
-            recip_name, recip_id, donor_name, donor_id, sender_fname, sender_lname, sender_uname, \
-                sender_id, rule_filter, black_list, and_list, or_list, rule_format, title, status, user_id = row
-
-            if recip_name != '__trash_bin__':
-                if recip_id == '' or donor_id == '':
-                    await tg_client.send_message(Config.app_channel_id,
-                                                 f'Recipient ID {recip_id} or Donor ID {donor_id} cannot be empty! Skipped')
-                    continue
-
-                # Very Important check: the recipient channel link must not be the same as the donor channel link,
-                # excluding link to special channel, which can only be created by system administrator!
-                if recip_id == donor_id:
-                    await tg_client.send_message(Config.app_channel_id,
-                        f'Skipped rule: {recip_id} == {donor_id} - matching input and output channels are prohibited!')
-                    continue
-
-            # check and convert str to int
-            if recip_id.startswith('100'):
-                recip_id = int(f'-{recip_id}') if not recip_id.startswith('-') else int(recip_id)
-            else:
-                recip_id = int(recip_id)
-
-            if donor_id.startswith('100'):
-                donor_id = int(f'-{donor_id}') if not donor_id.startswith('-') else int(donor_id)
-            else:
-                donor_id = int(donor_id) if donor_id else 0
-
-            sender_id = int(sender_id) if sender_id.isdigit() else 0
-            user_id = int(user_id) if user_id.isdigit() else 0
-
-            data["recip_name"] = recip_name
-            data["recip_id"] = recip_id
-            data["donor_name"] = donor_name
-            data["donor_id"] = donor_id
-            data["sender_fname"] = sender_fname
-            data["sender_lname"] = sender_lname
-            data["sender_uname"] = sender_uname
-            data["sender_id"] = sender_id
-            data["filter"] = rule_filter
-            data["black_list"] = black_list
-            data["and_list"] = and_list
-            data["or_list"] = or_list
-            data["format"] = rule_format or 'M'
-            data["title"] = title
-            data["status"] = status
-            data["user_id"] = user_id
-
-            await rt.add_rule(data)
-            new_rules_count += 1
-
-        await tg_client.send_message(Config.app_channel_id, f'{new_rules_count} rules was found and stored in database\n')
+    elapsed = time.perf_counter() - started
+    kind = 'bleep rules' if columns == 7 else 'rules'
+    report = f'{len(rules)} {kind} was found and stored in database\n' \
+             f'{row_count} rows in {elapsed:.2f} s ({row_count / max(elapsed, 1e-6):.0f} rows/s), ' \
+             f'{len(issues)} skipped\n'
+    if issues:
+        report += '\n' + '\n'.join(issues[:MAX_REPORTED_ISSUES])
+        if len(issues) > MAX_REPORTED_ISSUES:
+            report += f'\n...and {len(issues) - MAX_REPORTED_ISSUES} more'
+    await scheduler.send_message(Config.app_channel_id, report)
     return True
-
@@ -4,13 +4,24 @@ from typing import Any
 from telethon import TelegramClient, events, errors
 from telethon.tl.types import User, Channel
 import asyncio
+import copy
 import logging
-import re
+import signal
+import time
 
 from database.rules_io import cmd_export_rules, cmd_import_rules
+from shared.checkpoints import Checkpoints
 from shared.config import Config
-from database.orm_sqlite3 import Database, RulesTable, BleepTable
-from shared.filter_by_parameters import check_filter, flt
+from database.orm_sqlite3 import Database, RulesTable, BleepTable, VersionTable
+from shared.filter_by_parameters import RuleMatcher, MessageText
+from shared.entity_cache import EntityCache
+from shared.forward_batcher import ForwardBatcher
+from shared.rule_snapshot import RuleSnapshot
+from shared.rules_watcher import RulesWatcher
+from shared.outbox import Outbox
+from shared.pipeline import MessagePipeline
+from shared.send_scheduler import SendScheduler, TokenBucket
+from shared.trash_digest import TrashDigest
 
 
 # logging.basicConfig(level=logging.ERROR)
@@ -18,24 +29,51 @@ logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - [%(levelname)s] -  %(name)s - (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s"
 )
-tg_client = TelegramClient(Config.app_name, Config.api_id, Config.api_hash)
-db = Database(db_file=Config.database)
+# the updates are dispatched one by one: the handler waiting for room in the full pipeline holds the next updates
+# back (backpressure), instead of a new task for each update
+tg_client = TelegramClient(Config.app_name, Config.api_id, Config.api_hash, sequential_updates=True)
+db = Database(db_file=Config.database, workers=Config.db_workers)
+# all the outgoing messages go through the scheduler, the replies to the control channel go first
+scheduler = SendScheduler(tg_client, control_chat_id=Config.app_channel_id,
+                          global_rate=Config.send_global_rate, global_burst=Config.send_global_burst,
+                          chat_rate=Config.send_chat_rate, chat_burst=Config.send_chat_burst)
 
 current_state: dict[str, Any] = {}
 
-rules_list = []
-bleep_list = []
-recip_list = []
-trash_bin = {"name": '', 'id': 0, "status": '', "uid": 0}
+# the rules with their indexes and compiled conditions, the reload publishes the new snapshot by replacing
+# the reference (see RuleSnapshot), the messages being processed keep the snapshot they started with
+snapshot = RuleSnapshot()
+# the snapshots are built one at a time, each on top of the previous one
+snapshot_lock = asyncio.Lock()
 
-msg_queue = asyncio.Queue()
+# metadata of the chats (noforwards, admin rights) and of the senders of the messages
+chat_cache = EntityCache(max_size=Config.entity_cache_size, ttl=Config.entity_cache_ttl)
+sender_cache = EntityCache(max_size=Config.entity_cache_size, ttl=Config.entity_cache_ttl)
+
+
+class HistoryEvent:
+    """
+    The message fetched from the history of the chat, it stands for the new message event in the pipeline
+    """
+    def __init__(self, message):
+        self.message = message
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.message, name)
 
 
 class EventState:
-    def __init__(self, event):
+    def __init__(self, event, text: MessageText or None = None, messages: list or None = None):
         self.event = event
+        # all the messages of the album, event.message is the one with the caption
+        self.messages: list = messages or [event.message]
+        self.text: MessageText or None = text
         self.state: bool = False
-        self.reason: str = ''
+        self.reasons: list[str] = []    # why the rules rejected the message
+        self.changed: bool = False  # the text of the message was censored by the bleeping rules
+        self.snapshot: RuleSnapshot = snapshot  # the rules the message is checked with
+        self.backfill: bool = False         # the message was fetched from the history by the backfill
+        self.backfill_last: bool = False    # the last message of the backfill of the donor
 
     def set_event_state(self):
         self.state = True
@@ -43,26 +81,43 @@ class EventState:
     def clear_event_state(self):
         self.state = False
 
-    def set_reason(self, reason: str):
-        self.reason = reason
+    def add_reason(self, reason: str):
+        if reason and reason not in self.reasons:
+            self.reasons.append(reason)
 
     def get_event_state(self) -> bool:
         return self.state
 
     def get_reason(self) -> str:
-        return self.reason
+        return '\n'.join(self.reasons) if len(self.reasons) else 'unfiltered'
 
 
-async def reload_bleeps():
-    bleep_list.clear()
-    rules = await db.get_bleep_table().get_rules()
-    if len(rules) == 0:
-        await tg_client.send_message(Config.app_channel_id,
+async def load_bleeps():
+    """
+    Read the bleeping rules and publish the next snapshot with them
+    """
+    global snapshot
+    # the rules are read under the lock too, so the concurrent loads publish them in the order they were read
+    async with snapshot_lock:
+        version = await rules_watcher.version(VersionTable.BLEEPS)
+        # the error of the database is raised, so the current rules stay instead of no rules at all
+        rules = await db.get_bleep_table().get_rules(strict=True)
+        # the snapshot is built by a worker thread, the messages coming meanwhile are checked with the current one
+        snapshot = await asyncio.to_thread(snapshot.with_bleeps, rules)
+        rules_watcher.loaded(VersionTable.BLEEPS, version)
+    update_handlers()
+
+
+async def report_bleeps():
+    """
+    Post the list of the loaded bleeping rules to the control channel
+    """
+    if len(snapshot.bleeps) == 0:
+        await scheduler.send_message(Config.app_channel_id,
                                      "Bleep Rules not found. Fill the CSV file and upload it using command <import>")
         return False
-    for rule in rules:
-        bleep_list.append(rule)
-    await tg_client.send_message(Config.app_channel_id, f"**{len(bleep_list)} bleeping rules loaded:**\n\n")
+    bleep_list = snapshot.bleeps
+    await scheduler.send_message(Config.app_channel_id, f"**{len(bleep_list)} bleeping rules loaded:**\n\n")
     rules_text = ''
     for index, rule in enumerate(bleep_list):
         if (index + 1) % 5:
@@ -70,38 +125,51 @@ async def reload_bleeps():
         else:
             rules_text += f'**{index + 1}**. {BleepTable.serialize(rule)}\n\n'
             # print each 10 rules
-            await tg_client.send_message(Config.app_channel_id, rules_text)
+            await scheduler.send_message(Config.app_channel_id, rules_text)
             rules_text = ''
 
     if len(rules_text):
         # print last group of rules
-        await tg_client.send_message(Config.app_channel_id, rules_text)
+        await scheduler.send_message(Config.app_channel_id, rules_text)
     return len(bleep_list)
 
 
-async def reload_filters():
-    rules_list.clear()
-    rules = await db.get_rules_table().get_rules()
-    if len(rules) == 0:
-        await tg_client.send_message(Config.app_channel_id,
+async def reload_bleeps():
+    await load_bleeps()
+    return await report_bleeps()
+
+
+async def load_filters():
+    """
+    Read the rules and publish the next snapshot with them
+    """
+    global snapshot
+    # the rules are read under the lock too, so the concurrent loads publish them in the order they were read
+    async with snapshot_lock:
+        version = await rules_watcher.version(VersionTable.RULES)
+        # the error of the database is raised, so the current rules stay instead of no rules at all
+        rules = await db.get_rules_table().get_rules(strict=True)
+        # the rules are compiled beside the current ones by a worker thread and published at once, the messages
+        # coming meanwhile are checked with the previous rules
+        snapshot = await asyncio.to_thread(snapshot.with_rules, rules)
+        rules_watcher.loaded(VersionTable.RULES, version)
+    update_handlers()
+
+
+async def report_filters():
+    """
+    Post the list of the loaded rules and the status of the Trash Bin to the control channel
+    """
+    if len(snapshot.all_rules) == 0:
+        await scheduler.send_message(Config.app_channel_id,
                                      "Rules not found. Fill the CSV file and upload it using command <import>\n\n"
                                      "I'm ready to work.")
         return False
 
-    for rule in rules:
-        # store all recipient channels in list array for skip it's later when filtering messages
-        recip_list.append(rule.recip_id)
-
-        if rule.title == '__trash_bin__':
-            trash_bin["name"] = rule.recip_name
-            trash_bin["id"] = rule.recip_id
-            trash_bin["status"] = rule.status
-            trash_bin["uid"] = rule.uid
-            continue
-
-        rules_list.append(rule)
-
-    await tg_client.send_message(Config.app_channel_id, f"**{len(rules_list)} rules data loaded:**\n\n")
+    rules_list = snapshot.rules
+    await scheduler.send_message(Config.app_channel_id, f"**{len(rules_list)} rules data loaded:**\n"
+                                                        f"version {snapshot.version}, {snapshot.compiled} compiled, "
+                                                        f"{snapshot.reused} unchanged\n\n")
     rules_text = ''
     for index, rule in enumerate(rules_list):
         if (index + 1) % 5:
@@ -109,81 +177,173 @@ async def reload_filters():
         else:
             rules_text += f'**{index + 1}**. {RulesTable.serialize(rule)}\n\n'
             # print each 10 rules
-            await tg_client.send_message(Config.app_channel_id, rules_text)
+            await scheduler.send_message(Config.app_channel_id, rules_text)
             rules_text = ''
 
     if len(rules_text):
         # print last group of rules
-        await tg_client.send_message(Config.app_channel_id, rules_text)
+        await scheduler.send_message(Config.app_channel_id, rules_text)
+    trash_bin = snapshot.trash_bin
     trash_bin_status = "Trash Bin not initialized"
-    if trash_bin["id"]:
-        trash_bin_status = f"Trash Bin '{trash_bin['name']}' "
-        trash_bin_status += f"{'enabled' if trash_bin['status'] == 'active' else 'disabled'}"
+    if trash_bin.id:
+        trash_bin_status = f"Trash Bin '{trash_bin.name}' "
+        trash_bin_status += f"{'enabled' if trash_bin.status == 'active' else 'disabled'}"
     rules_text = f"**I'm ready to work.**\n{trash_bin_status}\n" \
                  f"Send me a 'help' command for information about control commands."
-    await tg_client.send_message(Config.app_channel_id, rules_text)
+    await scheduler.send_message(Config.app_channel_id, rules_text)
     return len(rules_list)
 
 
-async def main():
-    await db.create_tables()
+async def reload_filters():
+    await load_filters()
+    return await report_filters()
 
-    await reload_bleeps()
-    await reload_filters()
 
-    # start the consumer
-    # _ = asyncio.create_task(consumer())
-    await tg_client.run_until_disconnected()
+async def report_rules():
+    await report_bleeps()
+    await report_filters()
 
 
-def check_black_list(text: str, black_list: str):
+async def reload_changed_rules(changed: set[str]):
     """
-    Check each word in text (case-insensitive) and if one found in black list return boolean result
-    :param text: text for checking
-    :param black_list: forbidden list
-    :return: True means that All words in the message have been verified, False - was found
+    Load the rules changed in the database, quietly: the unchanged rules keep their compiled conditions
     """
-    if len(black_list):
-        opt = re.sub(r'[^\w\s]', '', text)  # remove all punctuations from string
-        strings = opt.lower().split()
-        bl_list = black_list.lower().split('|')
-        res = flt(strings, bl_list)
-        if len(res):
-            return False
-    return True
+    if VersionTable.BLEEPS in changed:
+        await load_bleeps()
+    if VersionTable.RULES in changed:
+        await load_filters()
+    logging.info(f"{', '.join(sorted(changed))} changed in the database, snapshot version {snapshot.version}: "
+                 f"{snapshot.compiled} compiled, {snapshot.reused} unchanged")
+
+
+# reloads the rules changed in the database by anyone, without the 'reload' command
+rules_watcher = RulesWatcher(db.get_version_table(), reload_changed_rules, interval=Config.rules_watch_interval)
 
 
-def check_or_list(text: str, or_list: str):
+async def set_trash_bin_status(status: str):
     """
-    (case-insensitive)
-    :param text: text for checking
-    :param or_list: a list of words, at least one of which must be found in the text
-    :return: Returns True if at least one word from the list is found in the text
+    Store the status of the Trash Bin rule and publish the snapshot with it, the watcher doesn't reload the rules
+    for this change
     """
-    if len(or_list):
-        opt = re.sub(r'[^\w\s]', '', text)  # remove all punctuations from string
-        strings = opt.lower().split()
-        ors = or_list.lower().split('|')
-        res = flt(strings, ors)
-        return len(res)
-    return True
+    global snapshot
+    async with snapshot_lock:
+        version = await rules_watcher.version(VersionTable.RULES)
+        await db.get_rules_table().update_rule(snapshot.trash_bin.uid, {"status": status})
+        snapshot = snapshot.with_trash_bin_status(status)
+        rules_watcher.changed_row(VersionTable.RULES, version, await rules_watcher.version(VersionTable.RULES))
 
 
-def check_for_and(text: str, and_list: str):
+def update_handlers():
     """
-    (case-insensitive)
-    :param text: text for checking
-    :param and_list: List of words that must be in the text
-    :return: Returns True if all words from the list are found in the text
+    Register the handlers of the messages only for the chats the client listens to: the donors of the active rules
+    and of the bleeping rules, and the control channel. The messages of all the other dialogs are dropped by
+    Telethon before the handlers are scheduled
     """
-    if len(and_list):
-        opt = re.sub(r'[^\w\s]', '', text)  # remove all punctuations from string
-        strings = opt.lower().split()
-        and_words_list = and_list.lower().split('+')
-        for and_word in and_words_list:
-            if len(flt(strings, [and_word])) == 0:
-                return False
-    return True
+    donors = snapshot.donors()
+    # there is no await between removing and adding the handlers, so no update is dispatched in between
+    tg_client.remove_event_handler(normal_handler)
+    tg_client.add_event_handler(normal_handler, events.NewMessage(chats=sorted(donors | {Config.app_channel_id})))
+    tg_client.remove_event_handler(album_handler)
+    if donors:
+        tg_client.add_event_handler(album_handler, events.Album(chats=sorted(donors)))
+
+
+async def main():
+    await db.create_tables()
+    await checkpoints.load()
+    # the control channel is listened to even before the rules are loaded
+    commands.start()
+    update_handlers()
+
+    # the messages are processed as soon as the rules are published, the list of the rules is posted meanwhile
+    started = time.perf_counter()
+    await load_bleeps()
+    await load_filters()
+
+    # start the workers processing the messages, the donors to be backfilled are held before
+    gaps = hold_backfill()
+    pipeline.start()
+    logging.info(f"{len(snapshot.all_rules)} rules and {len(snapshot.bleeps)} bleeping rules loaded, "
+                 f"ready in {time.perf_counter() - started:.2f} s")
+    report_task = asyncio.create_task(report_rules())
+    rules_watcher.start()
+    await resume_outbox()
+    retry_task = asyncio.create_task(retry_outbox())
+    backfill_task = asyncio.create_task(backfill(gaps))
+    tasks = [report_task, retry_task, backfill_task]
+
+    # SIGTERM (systemctl stop) and SIGINT stop the client while it's still connected, so the messages received
+    # already are processed and sent before exit
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stopping.set)
+
+    async def stop_on_signal():
+        await stopping.wait()
+        logging.info("stopping, the received messages are processed before exit")
+        await stop_processing(tasks)
+        await tg_client.disconnect()
+
+    signal_task = asyncio.create_task(stop_on_signal())
+    try:
+        await tg_client.run_until_disconnected()
+    finally:
+        if stopping.is_set():
+            await signal_task
+        else:
+            signal_task.cancel()
+        # the connection was lost otherwise, the state of the processed messages is stored anyway
+        await stop_processing(tasks)
+        await db.disconnect()
+
+
+async def stop_processing(tasks: list[asyncio.Task]):
+    """
+    Stop the intake of the messages and finish the work started already: the received messages are processed,
+    the collected forwards, digests, deliveries and checkpoints are sent and stored. Does nothing the second time
+    :param tasks: the background tasks to cancel
+    """
+    tg_client.remove_event_handler(normal_handler)
+    tg_client.remove_event_handler(album_handler)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await rules_watcher.stop()
+    await commands.stop()
+    await pipeline.stop()
+    await checkpoints.stop()
+    await forwarder.stop()
+    await trash_digest.stop()
+    await outbox.stop()
+    await scheduler.stop()
+
+
+def check_rule_text(rule, matcher: RuleMatcher, hits: set[int]) -> str:
+    """
+    Check the text of the message with the black_list, or_list, and_list and filter of the rule
+    :param rule: rule to check
+    :param matcher: compiled text conditions of the rule
+    :param hits: word ids found in the message
+    :return: the reason why the rule rejects the message, empty string if the message complies with the rule
+    """
+    if not matcher.check_black_list(hits):
+        return f"donor:{rule.donor_name}\n" \
+               f"This message contains word from \n" \
+               f"'Black list': {rule.black_list}"
+    if not matcher.check_or_list(hits):
+        return f"donor:{rule.donor_name}\n" \
+               f"This message doesn't contain any word from \n" \
+               f"'OR list': {rule.or_list}"
+    if not matcher.check_for_and(hits):
+        return f"donor:{rule.donor_name}\n" \
+               f"This message doesn't contain all words from \n" \
+               f"'AND list': {rule.and_list}"
+    if not matcher.check_filter(hits):
+        return f"donor:{rule.donor_name}\n" \
+               f"The text of this message does not match the specified \n" \
+               f"Filter: {rule.filter}"
+    return ''
 
 
 def check_user_prop(sender_prop, rule):
@@ -216,133 +376,105 @@ def measure_time(ch_id, msg_id):
         times_map.pop(msg_key)
 
 
+def message_link(event) -> str:
+    peer = event.message.peer_id
+    if event.is_private:
+        peer_id = peer.user_id
+    else:
+        peer_id = getattr(peer, 'channel_id', None) or getattr(peer, 'chat_id', 0)
+    return f'@t.me/c/{peer_id}/{event.message.id}\n'
+
+
+async def get_event_chat(event) -> Any:
+    """
+    The chat of the message usually comes with the update, otherwise it's taken from the cache or requested from
+    Telegram once
+    :param event: new message event
+    :return: chat entity
+    """
+    chat = event.chat
+    if chat is not None:
+        chat_cache.put(event.chat_id, chat)
+        return chat
+    return await chat_cache.get_or_load(event.chat_id, event.get_chat)
+
+
+async def get_sender_prop(event) -> dict[str, Any]:
+    """
+    :param event: new message event
+    :return: properties of the sender of the message, empty dict if the message wasn't sent by a user
+    """
+    sender = event.message.sender
+    sender_id = event.message.sender_id or 0
+    if sender is not None:
+        sender_cache.put(sender_id, sender)
+    elif sender_id:
+        sender = await sender_cache.get_or_load(sender_id, event.get_sender)
+    if type(sender) != User:
+        return {}
+    return {
+        "id": sender_id,
+        "uname": sender.username or '',
+        "fname": sender.first_name or '',
+        "lname": sender.last_name or ''
+    }
+
+
+async def send_album_copy(chat_id: int, event_state: EventState, header: str, **kwargs) -> Any:
+    """
+    Send the copy of the album as one album
+    :param chat_id: id of the recipient chat
+    :param event_state: the album
+    :param header: text added before the caption of the album
+    :param kwargs: arguments of scheduler.send_file
+    :return: the sent messages
+    """
+    caption_message = event_state.event.message
+    captions = [header + message.text if message is caption_message else message.text
+                for message in event_state.messages]
+    return await scheduler.send_file(chat_id, [message.media for message in event_state.messages], caption=captions,
+                                     **kwargs)
+
+
+async def send_event_copy(chat_id: int, event_state: EventState, header: str, **kwargs) -> Any:
+    """
+    Send the copy of the message, or of the whole album, with the header added before its text
+    """
+    if len(event_state.messages) > 1:
+        return await send_album_copy(chat_id, event_state, header, **kwargs)
+    message = copy.copy(event_state.event.message)
+    message.text = header + event_state.event.message.text
+    return await scheduler.send_message(chat_id, message, **kwargs)
+
+
 async def put_message_to_trash_bin(event, ev_state: EventState):
-    if trash_bin['status'] == 'active' and trash_bin['id']:
-        msg_link = f'reason: {ev_state.get_reason()}\n'
-        if event.is_private:
-            msg_link += f'@t.me/c/{event.message.peer_id.user_id}/{event.message.id}\n'
-        else:
-            msg_link += f'@t.me/c/{event.message.peer_id.channel_id}/{event.message.id}\n'
+    """
+    List the message, that wasn't sent to any recipient, in the next digest of the Trash Bin
+    """
+    trash_bin = ev_state.snapshot.trash_bin
+    if trash_bin.status == 'active' and trash_bin.id:
+        trash_digest.add(trash_bin.id, (event.chat_id, event.message.id), message_link(event), event.message.text,
+                         ev_state.reasons or ['unfiltered'])
 
-        event.message.text = msg_link + event.message.text
-        await tg_client.send_message(trash_bin['id'], event.message)
-        ev_state.set_event_state()
 
+async def post_trash_digest(chat_id: int, text: str):
+    await scheduler.send_message(chat_id, text, priority=SendScheduler.PRIORITY_LOW, parse_mode=None,
+                                 link_preview=False)
 
-@tg_client.on(events.NewMessage())
-async def normal_handler(event):
-    # check the commands sent to Config.app_channel
-    if event.chat_id == Config.app_channel_id:
-        text: str = event.message.text.lower().replace(' ', '')
-        if text == 'help':
-            help_text = f"**Hello {Config.owner_name}!**\n" \
-                        f"You can use the following commands to control:\n\n"\
-                        f"dialogs - show all the dialogs/conversations that you are part of;\n\n" \
-                        f"export - export rules definition into CSV file;\n\n" \
-                        f"import - import rules CSV file into database;\n\n" \
-                        f"reload - reload rules from database;\n\n" \
-                        f"trash - enable the Trash Bin functionality (all unfiltered messages will be " \
-                        f"collected here;\n\n" \
-                        f"notrash - disable trash bin functionality"
-            await tg_client.send_message(Config.app_channel_id, help_text)
-            return True
-        if text == 'trash':
-            if trash_bin['id']:
-                trash_bin['status'] = 'active'
-                await db.get_rules_table().update_rule(trash_bin["uid"], {"status": trash_bin['status']})
-                await tg_client.send_message(Config.app_channel_id, f"{trash_bin['name']} enabled")
-            else:
-                await tg_client.send_message(Config.app_channel_id,
-                                             f"Before using Trash Bin you need to initialize it!\n"
-                                             f"1. Create private channel in Telegram with any name\n"
-                                             f"2. Use  command 'dialogs' to retrieve this channel id\n"
-                                             f"3. Open rules definition CSV-file with Google Sheets, find or append "
-                                             f"the row with name '__trash_bin__' in column 'title' and insert "
-                                             f"the channel name into the column 'recip_name and "
-                                             f"the channel id into the column 'recip_id. Export CSV-file from "
-                                             f"Google Sheet and import it here using command 'import")
-            return True
-        if text == 'notrash':
-            if trash_bin['id']:
-                trash_bin['status'] = ''
-                await db.get_rules_table().update_rule(trash_bin["uid"], {"status": trash_bin['status']})
-                await tg_client.send_message(Config.app_channel_id, f"{trash_bin['name']} disabled")
-            else:
-                await tg_client.send_message(Config.app_channel_id, f"Trash Bin not initialized! Use command 'trash' "
-                                                                    f"for getting information about of Trash Bin "
-                                                                    f"initialization.")
-            return True
-        if text == 'dialogs':
-            # export all the dialogs/conversations that you are part of:
-            channels = []
-            groups = []
-            users = []
-            async for dialog in tg_client.iter_dialogs():
-                if dialog.is_group:
-                    groups.append(f"**{len(groups)+1}**. gr: {dialog.name}\t id: **{dialog.id}**\n")
-                elif dialog.is_channel:
-                    channels.append(f"**{len(channels)+1}**. ch: {dialog.name}\t id: **{dialog.id}**\n")
-                elif dialog.is_user:
-                    users.append(f"**{len(users)+1}**. user: {dialog.name}\t id: **{dialog.id}**\n")
-
-            # print dialogs list
-            my_dialogs = ''
-            for index, item in enumerate(channels):
-                my_dialogs += item
-                if (index+1) % 10 == 0:
-                    await tg_client.send_message(Config.app_channel_id, my_dialogs)
-                    my_dialogs = ''
-            if len(my_dialogs):
-                await tg_client.send_message(Config.app_channel_id, my_dialogs)
-
-            # await tg_client.send_message(Config.app_channel_id, f"\n+++ **Groups** +++\n")
-            my_dialogs = ''
-            for index, item in enumerate(groups):
-                my_dialogs += item
-                if (index+1) % 10 == 0:
-                    await tg_client.send_message(Config.app_channel_id, my_dialogs)
-                    my_dialogs = ''
-            if len(my_dialogs):
-                await tg_client.send_message(Config.app_channel_id, my_dialogs)
-
-            my_dialogs = ''
-            for index, item in enumerate(users):
-                my_dialogs += item
-                if (index+1) % 10 == 0:
-                    await tg_client.send_message(Config.app_channel_id, my_dialogs)
-                    my_dialogs = ''
-            if len(my_dialogs):
-                await tg_client.send_message(Config.app_channel_id, my_dialogs)
-            return True
-        if text == 'export':
-            await cmd_export_rules(db, tg_client)
-            return True
-        if text == 'import':
-            current_state["wait_for_rules_csv"] = True
-            await tg_client.send_message(Config.app_channel_id, f"**Hello {Config.owner_name}!**\nUpload CSV file with "
-                                                                f"new rules here and I'll import it into the database.")
-            return True
 
-        if event.message.document and (event.message.document.mime_type == 'text/comma-separated-values'
-                                       or event.message.document.mime_type == 'text/csv'):
-            if current_state.get("wait_for_rules_csv"):
-                doc = event.message.document
-                if await cmd_import_rules(db, tg_client, doc):
-                    await reload_bleeps()
-                    await reload_filters()
-                    current_state["wait_for_rules_csv"] = False
-                    return True
-            else:
-                await tg_client.send_message(Config.app_channel_id, "Unwanted operation detected. "
-                                                                    "If you want to send me a CSV file with new rules, "
-                                                                    "then you must use the command: import")
-            return False
-
-        if event.message.text == 'reload':
-            # in any case reload filters from database
-            await reload_bleeps()
-            return await reload_filters()
+# the rejected messages are posted to the Trash Bin in digests, not one by one
+trash_digest = TrashDigest(post_trash_digest, max_entries=Config.trash_digest_size,
+                           interval=Config.trash_digest_interval, sample_rate=Config.trash_sample_rate)
 
+
+async def normal_handler(event):
+    if event.chat_id == Config.app_channel_id:
+        # the updates are handled one by one, so the commands are run by their own worker in the order they came,
+        # and the messages of the donors don't wait for them
+        await commands.put(event.chat_id, event)
+        return False
+    if event.message.grouped_id:
+        # the messages of the album are processed all together by album_handler
         return False
     # now, lets filter all other messages
     # print(f"{event.message.peer_id.channel_id}/{event.message.id} msg: {event.message.text}")
@@ -350,502 +482,528 @@ async def normal_handler(event):
 
     # If a message arrives sent to one of the recipients' channels, then such a message should not be processed
     # exclude the case that this channel appears in bleep list as donor channel
-    is_bleep_rule = False
-    for bleep_rule in bleep_list:
-        if bleep_rule.donor_id == event.chat_id:
-            is_bleep_rule = True
+    is_bleep_rule = event.chat_id in snapshot.bleeps_by_donor
 
-    if not is_bleep_rule and event.chat_id in recip_list:
+    if not is_bleep_rule and event.chat_id in snapshot.recip_list:
         return False
 
-    # # all the main work of checking messages happens in the function consumer
-    # await msg_queue.put(EventState(event))
-    await process_bleep(event)
-    await process_msg(EventState(event))
-
-
-async def process_bleep(event):
-    for bleep_rule in bleep_list:
-        if bleep_rule.donor_id == event.chat_id:
-            # check each word in event.message.text for words in black list
-            need_editing_message = False
-            word_list = re.sub(r'[^\w\s]', '', event.message.text).lower().split()
-            for word in word_list:
-                if check_filter(word, bleep_rule.black_list):
-                    bleep = f'{len(word) * bleep_rule.bleep_symbol}'
-                    # replace 'word' on '****'
-                    event.message.text = event.message.text.replace(word, bleep)
-                    # replace 'Word' on '****'
-                    event.message.text = event.message.text.replace(word.capitalize(), bleep)
-                    # replace 'WORD' on '****'
-                    event.message.text = event.message.text.replace(word.upper(), bleep)
-                    need_editing_message = True
-
-            if need_editing_message:
-                if event.is_group:
-                    orig_mode = tg_client.parse_mode
-                    tg_client.parse_mode = 'html'
-                    await tg_client.delete_messages(event.chat_id, event.message.id)
-                    # non-personalized output
-                    # new_message = f'User {event.message.sender.first_name or ""} {event.message.sender.last_name or ""} ' \
-                    #               f'{"@" + event.message.sender.username or ""}\n' \
-                    #               f'sent message:\n' \
-                    #               f'{event.message.text}'
-                    # event.message.text = new_message
-                    await tg_client.send_message(event.chat_id, event.message, parse_mode='html')
-                    tg_client.parse_mode = orig_mode
-                elif event.is_channel and event.chat.admin_rights.edit_messages:
-                    await tg_client.edit_message(event.chat_id, event.message.id, event.message.text, parse_mode='html')
+    # all the main work of checking messages happens in the workers of the pipeline, the messages of the same donor
+    # are processed in order
+    checkpoints.live(event.chat_id, event.message.id)
+    await pipeline.put(event.chat_id, EventState(event))
+
+
+async def control_command(event):
+    """
+    Run the command sent to Config.app_channel
+    """
+    text: str = event.message.text.lower().replace(' ', '')
+    if text == 'help':
+        help_text = f"**Hello {Config.owner_name}!**\n" \
+                    f"You can use the following commands to control:\n\n"\
+                    f"dialogs - show all the dialogs/conversations that you are part of;\n\n" \
+                    f"export - export rules definition into CSV file;\n\n" \
+                    f"import - import rules CSV file into database;\n\n" \
+                    f"reload - reload rules from database;\n\n" \
+                    f"trash - enable the Trash Bin functionality (all unfiltered messages will be " \
+                    f"collected here;\n\n" \
+                    f"notrash - disable trash bin functionality"
+        await scheduler.send_message(Config.app_channel_id, help_text)
+        return True
+    if text == 'trash':
+        trash_bin = snapshot.trash_bin
+        if trash_bin.id:
+            await set_trash_bin_status('active')
+            await scheduler.send_message(Config.app_channel_id, f"{trash_bin.name} enabled")
+        else:
+            await scheduler.send_message(Config.app_channel_id,
+                                         f"Before using Trash Bin you need to initialize it!\n"
+                                         f"1. Create private channel in Telegram with any name\n"
+                                         f"2. Use  command 'dialogs' to retrieve this channel id\n"
+                                         f"3. Open rules definition CSV-file with Google Sheets, find or append "
+                                         f"the row with name '__trash_bin__' in column 'title' and insert "
+                                         f"the channel name into the column 'recip_name and "
+                                         f"the channel id into the column 'recip_id. Export CSV-file from "
+                                         f"Google Sheet and import it here using command 'import")
+        return True
+    if text == 'notrash':
+        trash_bin = snapshot.trash_bin
+        if trash_bin.id:
+            await set_trash_bin_status('')
+            await scheduler.send_message(Config.app_channel_id, f"{trash_bin.name} disabled")
+        else:
+            await scheduler.send_message(Config.app_channel_id, f"Trash Bin not initialized! Use command 'trash' "
+                                                                f"for getting information about of Trash Bin "
+                                                                f"initialization.")
+        return True
+    if text == 'dialogs':
+        # export all the dialogs/conversations that you are part of:
+        channels = []
+        groups = []
+        users = []
+        async for dialog in tg_client.iter_dialogs():
+            if dialog.is_group:
+                groups.append(f"**{len(groups)+1}**. gr: {dialog.name}\t id: **{dialog.id}**\n")
+            elif dialog.is_channel:
+                channels.append(f"**{len(channels)+1}**. ch: {dialog.name}\t id: **{dialog.id}**\n")
+            elif dialog.is_user:
+                users.append(f"**{len(users)+1}**. user: {dialog.name}\t id: **{dialog.id}**\n")
+
+        # print dialogs list
+        my_dialogs = ''
+        for index, item in enumerate(channels):
+            my_dialogs += item
+            if (index+1) % 10 == 0:
+                await scheduler.send_message(Config.app_channel_id, my_dialogs)
+                my_dialogs = ''
+        if len(my_dialogs):
+            await scheduler.send_message(Config.app_channel_id, my_dialogs)
+
+        # await scheduler.send_message(Config.app_channel_id, f"\n+++ **Groups** +++\n")
+        my_dialogs = ''
+        for index, item in enumerate(groups):
+            my_dialogs += item
+            if (index+1) % 10 == 0:
+                await scheduler.send_message(Config.app_channel_id, my_dialogs)
+                my_dialogs = ''
+        if len(my_dialogs):
+            await scheduler.send_message(Config.app_channel_id, my_dialogs)
+
+        my_dialogs = ''
+        for index, item in enumerate(users):
+            my_dialogs += item
+            if (index+1) % 10 == 0:
+                await scheduler.send_message(Config.app_channel_id, my_dialogs)
+                my_dialogs = ''
+        if len(my_dialogs):
+            await scheduler.send_message(Config.app_channel_id, my_dialogs)
+        return True
+    if text == 'export':
+        await cmd_export_rules(db, scheduler)
+        return True
+    if text == 'import':
+        current_state["wait_for_rules_csv"] = True
+        await scheduler.send_message(Config.app_channel_id, f"**Hello {Config.owner_name}!**\nUpload CSV file with "
+                                                            f"new rules here and I'll import it into the database.")
+        return True
+
+    if event.message.document and (event.message.document.mime_type == 'text/comma-separated-values'
+                                   or event.message.document.mime_type == 'text/csv'):
+        if current_state.get("wait_for_rules_csv"):
+            doc = event.message.document
+            if await cmd_import_rules(db, tg_client, scheduler, doc):
+                await reload_bleeps()
+                await reload_filters()
+                current_state["wait_for_rules_csv"] = False
+                return True
+        else:
+            await scheduler.send_message(Config.app_channel_id, "Unwanted operation detected. "
+                                                                "If you want to send me a CSV file with new rules, "
+                                                                "then you must use the command: import")
+        return False
+
+    if event.message.text == 'reload':
+        # in any case reload filters from database
+        await reload_bleeps()
+        return await reload_filters()
+
+    return False
+
+
+async def album_handler(event):
+    """
+    The grouped media come as one album, which is checked once by the caption and sent on as one album
+    """
+    if event.chat_id == Config.app_channel_id:
+        return False
+    if event.chat_id not in snapshot.bleeps_by_donor and event.chat_id in snapshot.recip_list:
+        return False
+    # the message with the caption stands for the whole album in the checks of the rules
+    event.message = next((message for message in event.messages if message.text), event.messages[0])
+    checkpoints.live(event.chat_id, min(message.id for message in event.messages))
+    await pipeline.put(event.chat_id, EventState(event, messages=list(event.messages)))
+
+
+async def process_event(event_state: EventState):
+    event = event_state.event
+    # the newest rules at the moment, the message is checked with them till the end even if the rules are reloaded
+    event_state.snapshot = snapshot
+    try:
+        event_state.changed = await process_bleep(event_state)
+        # the text of the message (censored already) is tokenized once, on first use, and shared by all the checks
+        event_state.text = MessageText(event.message.text)
+        await process_msg(event_state)
+    finally:
+        checkpoints.update(event.chat_id, max(message.id for message in event_state.messages),
+                           backfill=event_state.backfill)
+        if event_state.backfill_last:
+            checkpoints.release(event.chat_id)
+
+
+async def process_bleep(event_state: EventState) -> bool:
+    """
+    Censor the message with the bleeping rules of its chat
+    :param event_state: new message or album
+    :return: True, if the text of the message was changed
+    """
+    event = event_state.event
+    message_changed = False
+    bleep_censors = event_state.snapshot.bleep_censors
+    for bleep_rule in event_state.snapshot.bleeps_by_donor.get(event.chat_id, []):
+        # replace all the forbidden words, in any case, on '****' in one pass
+        bleeped_text, hits = bleep_censors[bleep_rule.uid].bleep(event.message.text)
+        if hits and bleeped_text != event.message.text:
+            event.message.text = bleeped_text
+            message_changed = True
+            if event.is_group:
+                await scheduler.delete_messages(event.chat_id, [message.id for message in event_state.messages])
+                # non-personalized output
+                # new_message = f'User {event.message.sender.first_name or ""} {event.message.sender.last_name or ""} ' \
+                #               f'{"@" + event.message.sender.username or ""}\n' \
+                #               f'sent message:\n' \
+                #               f'{event.message.text}'
+                # event.message.text = new_message
+                await send_event_copy(event.chat_id, event_state, '', parse_mode='html')
+            elif event.is_channel:
+                chat = await get_event_chat(event)
+                admin_rights = getattr(chat, 'admin_rights', None)
+                if admin_rights and admin_rights.edit_messages:
+                    await scheduler.edit_message(event.chat_id, event.message.id, event.message.text,
+                                                 parse_mode='html')
+    return message_changed
 
 
 async def process_msg(event_state: EventState):
-    event_state.set_reason('unfiltered')
     event = event_state.event
-    for rule in rules_list:
-        # print(f'{event.chat_id=}')
-        if rule.status != 'active':
+    text = event_state.text
+    current = event_state.snapshot
+    rules = []
+    if event.chat_id in current.rules_by_donor:
+        # one scan of the message finds the words of all the rules, each rule then only checks the ids of its words
+        hits = current.rule_words.scan(text)
+        # and the rules that can't accept the message, because it doesn't contain any of their required words,
+        # aren't checked at all
+        rules = current.candidate_rules(event.chat_id, hits)
+        if not len(rules):
+            event_state.add_reason(f"donor:{current.rules_by_donor[event.chat_id][0].donor_name}\n"
+                                   f"This message doesn't contain any of the words required by the rules")
+    msg_link = message_link(event)
+    sender_prop = None  # properties of the sender, resolved once, when the first rule needs them
+    deliveries = []     # (rule, header of the message) for each rule that accepted the message
+    for rule in rules:
+        matcher = current.rule_matchers[rule.uid]
+        format_string = rule_format(rule)
+
+        if event.is_group:
+            sender_defined = rule.sender_id or rule.sender_uname or rule.sender_fname or rule.sender_lname
+            if sender_prop is None and (sender_defined or 's' in format_string):
+                sender_prop = await get_sender_prop(event)
+            # the sender is checked only if the rule defines it and the message was sent by a user
+            if sender_defined and sender_prop and not check_user_prop(sender_prop, rule):
+                event_state.add_reason(f'donor:{rule.donor_name}\n'
+                                       f'Specified sender not found.\n'
+                                       f'sender: id:{sender_prop["id"]} un:{sender_prop["uname"]} '
+                                       f'fn:{sender_prop["fname"]} ln:{sender_prop["lname"]}')
+                continue
+
+        # check black_list, and_list, or_list and filter
+        reason = check_rule_text(rule, matcher, hits)
+        if reason:
+            event_state.add_reason(reason)
             continue
-        # print(f'{event.chat_id=} - is active')
-        chat = await event.get_input_chat()
-        sndr = await event.get_sender()
-        btns = await event.get_buttons()
-
-        if rule.donor_id == event.chat_id:
-            event_state.set_reason('')
-            event_state.clear_event_state()
-            if event.is_group:
-                username = ''
-                firstname = ''
-                lastname = ''
-                sender_id = 0
-                is_found = False
-
-                # print(in case of message sent by user, get his properties")
-                if event.message and event.message.sender and type(event.message.sender) == User:
-                    username = event.message.sender.username or ''
-                    firstname = event.message.sender.first_name or ''
-                    lastname = event.message.sender.last_name or ''
-                    sender_id = event.message.sender_id or 0
-                else:
-                    is_found = True  # current message doesn't contain user information, so set flag the,
-                    # to skip sender checking
-
-                if not is_found:
-                    if rule.sender_id == 0 and rule.sender_uname == '' and \
-                            rule.sender_fname == '' and rule.sender_lname == '':
-                        is_found = True  # the current rule doesn't contain user definition, so set the
-                        # flag for exclude sender checking
-
-                if not is_found:
-                    # lets check sender properties
-                    is_found = check_user_prop({
-                        "id": sender_id,
-                        "uname": username,
-                        "fname": firstname,
-                        "lname": lastname
-                    }, rule)
-                    if not is_found:
-                        event_state.set_reason(f'donor:{rule.donor_name}\n'
-                                               f'Specified sender not found.\n'
-                                               f'sender: id:{sender_id} un:{username} '
-                                               f'fn:{firstname} ln:{lastname}')
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-                        continue
-
-                if is_found:
-                    # check black_list, and_list and or_list
-                    if not check_black_list(event.message.text, rule.black_list):
-                        event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                               f"This message contains word from \n"
-                                               f"'Black list': {rule.black_list}")
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-                        continue
-                    if not check_or_list(event.message.text, rule.or_list):
-                        event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                               f"This message doesn't contain any word from \n"
-                                               f"'OR list': {rule.or_list}")
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-                        continue
-                    if not check_for_and(event.message.text, rule.and_list):
-                        event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                               f"This message doesn't contain all words from \n"
-                                               f"'AND list': {rule.and_list}")
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-                        continue
-
-                    # check filter now
-                    is_found = check_filter(event.message.text, rule.filter)
-                    if not is_found:
-                        event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                               f"The text of this message does not match the specified \n"
-                                               f"Filter: {rule.filter}")
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-                        continue
-                try:
-                    if is_found:
-                        if len(username) > 0:
-                            username = username if username.startswith("@") else f"@{username}"
-
-                        format_string = "m" if len(rule.format) == 0 else rule.format.lower()
-                        title_info = ''
-                        donor_info = ''
-                        sender_info = ''
-                        message_body = ''
-
-                        if 't' in format_string:
-                            title_info = f'**{rule.title}**\n' if len(
-                                rule.title) else f'**flt: {rule.filter}**\n'
-                        if 'd' in format_string:
-                            donor_info = f'**{rule.donor_name}** id:{rule.donor_id}\n'
-                        if 's' in format_string:
-                            sender_info = f'**{firstname} {lastname}** {username} id:{sender_id}\n'
-
-                        if title_info or donor_info or sender_info:
-                            message_body += f'{title_info}{donor_info}{sender_info}' + \
-                                            f'@t.me/c/{event.message.peer_id.channel_id}/{event.message.id}\n' \
-                                            f'----------\n'
-
-                        if 'm' not in format_string:
-                            event_state.set_event_state()
-                            await tg_client.send_message(rule.recip_id, message_body)
-                        else:
-                            if not Config.enable_forbidden_content:
-                                if event.message.chat and event.message.chat.noforwards:
-                                    message_body += f"Forwards restricted saving content from chat " \
-                                                    f"{event.chat_id} is forbidden."
-                                    await tg_client.send_message(rule.recip_id, message_body)
-                                    continue
-                            message_body += event.message.text
-                            event.message.text = message_body
-                            event_state.set_event_state()
-                            await tg_client.send_message(rule.recip_id, event.message)
-
-                            # measure_time(event.message.peer_id.channel_id, event.message.id)
-
-                # Это просто пример как обрабатывать ошибки telethon
-                # except (errors.SessionExpiredError, errors.SessionRevokedError):
-                #         self._logger.critical(
-                #             "The user's session has expired, "
-                #             "try to get a new session key (run login.py)"
-                #         )
-                except Exception as e:
-                    await tg_client.send_message(Config.app_channel_id,
-                                                 f"{'Error!'} \n{str(e)}\n"
-                                                 f"{rule.title}\n"
-                                                 f"R: {rule.recip_id}\n"
-                                                 f"D: {rule.donor_id}\n"
-                                                 f"@t.me/c/{event.message.peer_id.channel_id}/{event.message.id}\n")
-                finally:
-                    continue
-            else:
-                title_info = ''
-                donor_info = ''
-                message_body = ''
-                msg_link = ''
-                try:
-                    # check black_list, and_list and or_list
-                    if not check_black_list(event.message.text, rule.black_list):
-                        event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                               f"This message contains word from \n"
-                                               f"'Black list': {rule.black_list}")
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-                        continue
-                    if not check_or_list(event.message.text, rule.or_list):
-                        event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                               f"This message doesn't contain any word from \n"
-                                               f"'OR list': {rule.or_list}")
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-                        continue
-                    if not check_for_and(event.message.text, rule.and_list):
-                        event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                               f"This message doesn't contain all words from \n"
-                                               f"'AND list': {rule.and_list}")
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-                        continue
-
-                    if event.is_private:
-                        msg_link += f'@t.me/c/{event.message.peer_id.user_id}/{event.message.id}\n'
-                    else:
-                        msg_link += f'@t.me/c/{event.message.peer_id.channel_id}/{event.message.id}\n'
-
-                    # check filter
-                    if check_filter(event.message.text, rule.filter):
-                        format_string = "m" if len(rule.format) == 0 else rule.format.lower()
-                        if 't' in format_string:
-                            title_info = f'**{rule.title}**\n' if len(
-                                rule.title) else f'**flt: {rule.filter}**\n'
-                        if 'd' in format_string:
-                            donor_info = f'**{rule.donor_name}** id:{rule.donor_id}\n'
-
-                        if title_info or donor_info:
-                            message_body += f'{title_info}{donor_info}'
-
-                            message_body += msg_link
-                            message_body += f'----------\n'
-
-                        if 'm' not in format_string:
-                            event_state.set_event_state()
-                            await tg_client.send_message(rule.recip_id, message_body)
-                        else:
-                            if not Config.enable_forbidden_content:
-                                if event.message.chat and event.message.chat.noforwards:
-                                    message_body += f"Forwards restricted saving content from chat " \
-                                                    f"{event.chat_id} is forbidden."
-                                    await tg_client.send_message(rule.recip_id, message_body)
-                                    continue
-                            message_body += event.message.text
-                            event.message.text = message_body
-                            event_state.set_event_state()
-                            await tg_client.send_message(rule.recip_id, event.message)
-
-                            # measure_time(event.message.peer_id.channel_id, event.message.id)
-                    else:
-                        event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                               f"The text of this message does not match the specified \n"
-                                               f"Filter: {rule.filter}")
-                        await put_message_to_trash_bin(event, ev_state=event_state)
-
-                except Exception as e:
-                    await tg_client.send_message(Config.app_channel_id,
-                                                 f"{'Error!'} \n{str(e)}\n"
-                                                 f"{rule.title}\n"
-                                                 f"R: {rule.recip_id}\n"
-                                                 f"D: {rule.donor_id}\n"
-                                                 f"{msg_link}\n")
-                finally:
-                    continue
 
+        title_info = ''
+        donor_info = ''
+        sender_info = ''
+        message_body = ''
+
+        if 't' in format_string:
+            title_info = f'**{rule.title}**\n' if len(
+                rule.title) else f'**flt: {rule.filter}**\n'
+        if 'd' in format_string:
+            donor_info = f'**{rule.donor_name}** id:{rule.donor_id}\n'
+        if 's' in format_string and event.is_group:
+            username = sender_prop.get("uname", '')
+            if len(username) > 0:
+                username = username if username.startswith("@") else f"@{username}"
+            sender_info = f'**{sender_prop.get("fname", "")} {sender_prop.get("lname", "")}** {username} ' \
+                          f'id:{sender_prop.get("id", 0)}\n'
+
+        if title_info or donor_info or sender_info:
+            message_body += f'{title_info}{donor_info}{sender_info}{msg_link}----------\n'
+        deliveries.append((rule, message_body))
+
+    if len(deliveries):
+        await fan_out(event_state, deliveries, msg_link)
+
+    # the message, that wasn't sent to any recipient, goes to the Trash Bin once with all the reasons
     if not event_state.get_event_state():
         await put_message_to_trash_bin(event, ev_state=event_state)
 
 
-# temporary not in use
-async def consumer():
-    while True:
+def rule_format(rule) -> str:
+    """
+    :return: the format of the rule in lower case, 'm' if it isn't set
+        t - title of the rule, d - donor, s - sender of the message, m - the message,
+        f - forward the original message by Telegram (without a header)
+    """
+    return "m" if len(rule.format) == 0 else rule.format.lower()
+
+
+def report_forward_sent(chat_id: int, from_peer: int, message_ids: list[int]):
+    for message_id in message_ids:
+        outbox.done(from_peer, message_id, chat_id)
+
+
+async def report_forward_error(chat_id: int, from_peer: int, message_ids: list[int], e: Exception):
+    for message_id in message_ids:
+        outbox.failed(from_peer, message_id, chat_id)
+    await scheduler.send_message(Config.app_channel_id,
+                                 f"{'Error!'} \n{str(e)}\n"
+                                 f"Forwarding of {len(message_ids)} messages failed\n"
+                                 f"R: {chat_id}\n"
+                                 f"D: {from_peer}\n"
+                                 f"ids: {', '.join(str(message_id) for message_id in message_ids)}\n")
+
+
+# the messages forwarded by Telegram itself, the bursts of one donor are forwarded by one request
+forwarder = ForwardBatcher(scheduler, delay=Config.forward_batch_delay,
+                           on_sent=report_forward_sent, on_error=report_forward_error)
+# the last processed message of each donor, the messages posted while the client was down are backfilled
+checkpoints = Checkpoints(db.get_checkpoint_table(), interval=Config.checkpoint_interval)
+# the deliveries are stored before sending, so the deliveries interrupted by a restart are sent after it
+outbox = Outbox(db.get_outbox_table(), interval=Config.outbox_commit_interval,
+                max_attempts=Config.outbox_max_attempts, pending_ttl=Config.outbox_pending_ttl)
+
+
+async def deliver_entry(entry: dict[str, Any], event_state: EventState):
+    """
+    Send one delivery of the outbox
+    :param entry: the delivery, see OutboxTable
+    :param event_state: the message or the album of the delivery
+    """
+    if entry["kind"] == 'forward':
+        # the batch is forwarded in the background, it's marked sent by report_forward_sent
+        message_ids = [int(message_id) for message_id in entry["message_ids"].split(',')]
+        forwarder.forward(entry["recip_id"], message_ids, entry["donor_id"])
+        return
+    if entry["kind"] == 'text':
+        await scheduler.send_message(entry["recip_id"], entry["header"])
+    else:
+        await send_event_copy(entry["recip_id"], event_state, entry["header"])
+        # measure_time(event.message.peer_id.channel_id, event.message.id)
+    outbox.done(*Outbox.key(entry))
+
+
+async def fan_out(event_state: EventState, deliveries: list[tuple[Any, str]], msg_link: str):
+    """
+    Send the message to all the recipients concurrently, each recipient gets its own copy of the message.
+    The deliveries are stored in the outbox first, the deliveries of the message stored already aren't repeated
+    :param event_state: the message
+    :param deliveries: (rule, header of the message) for each rule that accepted the message
+    :param msg_link: link to the original message
+    """
+    event = event_state.event
+
+    def is_forwarded(rule) -> bool:
+        # Telegram forwards the message itself, when the message isn't changed: the rules with the format 'f',
+        # and the plain 'm' rules (without a header) if Config.auto_forward is set
+        format_string = rule_format(rule)
+        return not event_state.changed and ('f' in format_string or (Config.auto_forward and format_string == 'm'))
+
+    # the chat is requested only if one of the rules sends or forwards the message itself
+    copied = not Config.enable_forbidden_content and any(set(rule_format(rule)) & {'m', 'f'} for rule, _ in deliveries)
+    restricted = False
+    if copied or any(is_forwarded(rule) for rule, _ in deliveries):
+        chat = await get_event_chat(event)
+        restricted = getattr(chat, 'noforwards', False)
+    noforwards = restricted and not Config.enable_forbidden_content
+
+    message_ids = ','.join(str(message.id) for message in event_state.messages)
+    entries = []
+    for rule, message_body in deliveries:
+        format_string = rule_format(rule)
+        if is_forwarded(rule) and not restricted:
+            kind = 'forward'
+        elif 'm' not in format_string and 'f' not in format_string:
+            kind = 'text'
+        elif noforwards:
+            kind = 'text'
+            message_body += f"Forwards restricted saving content from chat " \
+                            f"{event.chat_id} is forbidden."
+        else:
+            kind = 'copy'
+        if kind != 'text' or not noforwards:
+            event_state.set_event_state()
+        entries.append({"donor_id": event.chat_id, "msg_id": event.message.id, "recip_id": rule.recip_id,
+                        "message_ids": message_ids, "kind": kind, "header": message_body})
+    added = await outbox.add(entries)
+
+    concurrency = asyncio.Semaphore(Config.fanout_concurrency)
+
+    async def deliver(rule, entry: dict[str, Any]) -> str:
+        async with concurrency:
+            try:
+                await deliver_entry(entry, event_state)
+
+            # Это просто пример как обрабатывать ошибки telethon
+            # except (errors.SessionExpiredError, errors.SessionRevokedError):
+            #         self._logger.critical(
+            #             "The user's session has expired, "
+            #             "try to get a new session key (run login.py)"
+            #         )
+            except errors.FloodWaitError as e:
+                outbox.failed(*Outbox.key(entry))
+                # don't make the flood worse by reporting it to the control channel
+                logging.warning(f"{rule.title} R: {rule.recip_id} D: {rule.donor_id} {msg_link.strip()} - {str(e)}")
+            except Exception as e:
+                outbox.failed(*Outbox.key(entry))
+                return f"{str(e)}\n" \
+                       f"{rule.title}\n" \
+                       f"R: {rule.recip_id}\n" \
+                       f"D: {rule.donor_id}\n"
+        return ''
+
+    results = await asyncio.gather(*[deliver(rule, entry)
+                                     for (rule, _), entry, is_added in zip(deliveries, entries, added) if is_added])
+    # report all the failed deliveries of the message at once
+    errors_text = [result for result in results if result]
+    if len(errors_text):
+        await scheduler.send_message(Config.app_channel_id,
+                                     f"{'Error!'} {len(errors_text)} of {len(deliveries)} deliveries failed\n"
+                                     f"{msg_link}\n" + '\n'.join(errors_text))
+
+
+async def resume_outbox():
+    """
+    Send the deliveries left unsent by the previous run of the client and the ones failed during this run
+    """
+    entries = await outbox.pending()
+    if not len(entries):
+        return
+    logging.info(f"resuming {len(entries)} deliveries from the outbox")
+    # the messages of the deliveries are requested from Telegram by one request for each donor
+    by_donor: dict[int, list] = {}
+    for entry in entries:
+        by_donor.setdefault(entry.donor_id, []).append(entry._asdict())
+    for donor_id, donor_entries in by_donor.items():
+        message_ids = sorted({int(message_id) for entry in donor_entries
+                              for message_id in entry["message_ids"].split(',')})
         try:
-            event_state: EventState = msg_queue.get_nowait()
-            event_state.set_reason('unfiltered')
-            event = event_state.event
-            for rule in rules_list:
-                # print(f'{event.chat_id=}')
-                if rule.status != 'active':
-                    continue
-                # print(f'{event.chat_id=} - is active')
-                # chat = await event.get_input_chat()
-                # sndr = await event.get_sender()
-                # btns = await event.get_buttons()
-
-                if rule.donor_id == event.chat_id:
-                    event_state.set_reason('')
-                    event_state.clear_event_state()
-                    if event.is_group:
-                        username = ''
-                        firstname = ''
-                        lastname = ''
-                        sender_id = 0
-                        is_found = False
-
-                        # print(in case of message sent by user, get his properties")
-                        if event.message and event.message.sender and type(event.message.sender) == User:
-                            username = event.message.sender.username or ''
-                            firstname = event.message.sender.first_name or ''
-                            lastname = event.message.sender.last_name or ''
-                            sender_id = event.message.sender_id or 0
-                        else:
-                            is_found = True  # current message doesn't contain user information, so set flag the,
-                            # to skip sender checking
-
-                        if not is_found:
-                            if rule.sender_id == 0 and rule.sender_uname == '' and \
-                                    rule.sender_fname == '' and rule.sender_lname == '':
-                                is_found = True  # the current rule doesn't contain user definition, so set the
-                                # flag for exclude sender checking
-
-                        if not is_found:
-                            # lets check sender properties
-                            is_found = check_user_prop({
-                                "id": sender_id,
-                                "uname": username,
-                                "fname": firstname,
-                                "lname": lastname
-                            }, rule)
-                            if not is_found:
-                                event_state.set_reason(f'donor:{rule.donor_name}\n'
-                                                       f'Specified sender not found.\n'
-                                                       f'sender: id:{sender_id} un:{username} '
-                                                       f'fn:{firstname} ln:{lastname}')
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-                                continue
-
-                        if is_found:
-                            # check black_list, and_list and or_list
-                            if not check_black_list(event.message.text, rule.black_list):
-                                event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                                       f"This message contains word from \n"
-                                                       f"'Black list': {rule.black_list}")
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-                                continue
-                            if not check_or_list(event.message.text, rule.or_list):
-                                event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                                       f"This message doesn't contain any word from \n"
-                                                       f"'OR list': {rule.or_list}")
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-                                continue
-                            if not check_for_and(event.message.text, rule.and_list):
-                                event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                                       f"This message doesn't contain all words from \n"
-                                                       f"'AND list': {rule.and_list}")
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-                                continue
-
-                            # check filter now
-                            is_found = check_filter(event.message.text, rule.filter)
-                            if not is_found:
-                                event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                                       f"The text of this message does not match the specified \n"
-                                                       f"Filter: {rule.filter}")
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-                                continue
-                        try:
-                            if is_found:
-                                if len(username) > 0:
-                                    username = username if username.startswith("@") else f"@{username}"
-
-                                format_string = "m" if len(rule.format) == 0 else rule.format.lower()
-                                title_info = ''
-                                donor_info = ''
-                                sender_info = ''
-                                message_body = ''
-
-                                if 't' in format_string:
-                                    title_info = f'**{rule.title}**\n' if len(
-                                        rule.title) else f'**flt: {rule.filter}**\n'
-                                if 'd' in format_string:
-                                    donor_info = f'**{rule.donor_name}** id:{rule.donor_id}\n'
-                                if 's' in format_string:
-                                    sender_info = f'**{firstname} {lastname}** {username} id:{sender_id}\n'
-
-                                if title_info or donor_info or sender_info:
-                                    message_body += f'{title_info}{donor_info}{sender_info}' + \
-                                                    f'@t.me/c/{event.message.peer_id.channel_id}/{event.message.id}\n' \
-                                                    f'----------\n'
-
-                                if 'm' not in format_string:
-                                    event_state.set_event_state()
-                                    await tg_client.send_message(rule.recip_id, message_body)
-                                else:
-                                    if not Config.enable_forbidden_content:
-                                        if event.message.chat and event.message.chat.noforwards:
-                                            message_body += f"Forwards restricted saving content from chat " \
-                                                            f"{event.chat_id} is forbidden."
-                                            await tg_client.send_message(rule.recip_id, message_body)
-                                            continue
-                                    message_body += event.message.text
-                                    event.message.text = message_body
-                                    event_state.set_event_state()
-                                    await tg_client.send_message(rule.recip_id, event.message)
-
-                                    # measure_time(event.message.peer_id.channel_id, event.message.id)
-
-                        # Это просто пример как обрабатывать ошибки telethon
-                        # except (errors.SessionExpiredError, errors.SessionRevokedError):
-                        #         self._logger.critical(
-                        #             "The user's session has expired, "
-                        #             "try to get a new session key (run login.py)"
-                        #         )
-                        except Exception as e:
-                            await tg_client.send_message(Config.app_channel_id,
-                                                         f"{'Error!'} \n{str(e)}\n"
-                                                         f"{rule.title}\n"
-                                                         f"R: {rule.recip_id}\n"
-                                                         f"D: {rule.donor_id}\n"
-                                                         f"@t.me/c/{event.message.peer_id.channel_id}/{event.message.id}\n")
-                        finally:
-                            continue
-                    else:
-                        title_info = ''
-                        donor_info = ''
-                        message_body = ''
-                        msg_link = ''
-                        try:
-                            # check black_list, and_list and or_list
-                            if not check_black_list(event.message.text, rule.black_list):
-                                event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                                       f"This message contains word from \n"
-                                                       f"'Black list': {rule.black_list}")
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-                                continue
-                            if not check_or_list(event.message.text, rule.or_list):
-                                event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                                       f"This message doesn't contain any word from \n"
-                                                       f"'OR list': {rule.or_list}")
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-                                continue
-                            if not check_for_and(event.message.text, rule.and_list):
-                                event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                                       f"This message doesn't contain all words from \n"
-                                                       f"'AND list': {rule.and_list}")
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-                                continue
-
-                            if event.is_private:
-                                msg_link += f'@t.me/c/{event.message.peer_id.user_id}/{event.message.id}\n'
-                            else:
-                                msg_link += f'@t.me/c/{event.message.peer_id.channel_id}/{event.message.id}\n'
-
-                            # check filter
-                            if check_filter(event.message.text, rule.filter):
-                                format_string = "m" if len(rule.format) == 0 else rule.format.lower()
-                                if 't' in format_string:
-                                    title_info = f'**{rule.title}**\n' if len(
-                                        rule.title) else f'**flt: {rule.filter}**\n'
-                                if 'd' in format_string:
-                                    donor_info = f'**{rule.donor_name}** id:{rule.donor_id}\n'
-
-                                if title_info or donor_info:
-                                    message_body += f'{title_info}{donor_info}'
-
-                                    message_body += msg_link
-                                    message_body += f'----------\n'
-
-                                if 'm' not in format_string:
-                                    event_state.set_event_state()
-                                    await tg_client.send_message(rule.recip_id, message_body)
-                                else:
-                                    if not Config.enable_forbidden_content:
-                                        if event.message.chat and event.message.chat.noforwards:
-                                            message_body += f"Forwards restricted saving content from chat " \
-                                                            f"{event.chat_id} is forbidden."
-                                            await tg_client.send_message(rule.recip_id, message_body)
-                                            continue
-                                    message_body += event.message.text
-                                    event.message.text = message_body
-                                    event_state.set_event_state()
-                                    await tg_client.send_message(rule.recip_id, event.message)
-
-                                    # measure_time(event.message.peer_id.channel_id, event.message.id)
-                            else:
-                                event_state.set_reason(f"donor:{rule.donor_name}\n"
-                                                       f"The text of this message does not match the specified \n"
-                                                       f"Filter: {rule.filter}")
-                                await put_message_to_trash_bin(event, ev_state=event_state)
-
-                        except Exception as e:
-                            await tg_client.send_message(Config.app_channel_id,
-                                                         f"{'Error!'} \n{str(e)}\n"
-                                                         f"{rule.title}\n"
-                                                         f"R: {rule.recip_id}\n"
-                                                         f"D: {rule.donor_id}\n"
-                                                         f"{msg_link}\n")
-                        finally:
-                            continue
-
-            if not event_state.get_event_state():
-                await put_message_to_trash_bin(event, ev_state=event_state)
-            msg_queue.task_done()
-        except asyncio.QueueEmpty:
-            await asyncio.sleep(0.5)
+            messages = {message.id: message
+                        for message in await tg_client.get_messages(donor_id, ids=message_ids) if message}
+        except Exception as e:
+            logging.warning(f"messages of {donor_id} for the outbox not found: {str(e)}")
+            for entry in donor_entries:
+                outbox.failed(*Outbox.key(entry))
             continue
+        for entry in donor_entries:
+            album = [messages[int(message_id)] for message_id in entry["message_ids"].split(',')
+                     if int(message_id) in messages]
+            caption = messages.get(entry["msg_id"])
+            if caption is None or not album:
+                # the message was deleted in the donor chat
+                outbox.failed(*Outbox.key(entry))
+                continue
+            try:
+                await deliver_entry(entry, EventState(HistoryEvent(caption), messages=album))
+            except Exception as e:
+                outbox.failed(*Outbox.key(entry))
+                logging.warning(f"R: {entry['recip_id']} D: {donor_id} resumed delivery failed - {str(e)}")
+
+
+async def retry_outbox():
+    """
+    Send the failed deliveries again each Config.outbox_retry_interval seconds, while the client is running
+    """
+    while True:
+        await asyncio.sleep(Config.outbox_retry_interval)
+        try:
+            await resume_outbox()
+        except Exception as e:
+            logging.warning(f"retry of the outbox failed: {str(e)}")
+
+
+def history_events(messages: list) -> list[EventState]:
+    """
+    :param messages: messages of the chat in the order they were posted
+    :return: the messages, the messages of an album are joined into one EventState as album_handler does
+    """
+    event_states = []
+    album = []
+    for message in messages + [None]:
+        if album and (message is None or message.grouped_id != album[0].grouped_id):
+            caption = next((album_message for album_message in album if album_message.text), album[0])
+            event_states.append(EventState(HistoryEvent(caption), messages=album))
+            album = []
+        if message is None:
+            break
+        if message.grouped_id:
+            album.append(message)
+        else:
+            event_states.append(EventState(HistoryEvent(message)))
+    return event_states
+
+
+def hold_backfill() -> dict[int, int]:
+    """
+    Hold the checkpoints of the donors before the first live message is processed, otherwise the live messages
+    move the checkpoints over the gaps
+    :return: donor_id -> id of the last message processed before the restart, for the donors having a checkpoint
+    """
+    gaps = {donor_id: checkpoints.get(donor_id) for donor_id in snapshot.donors() if checkpoints.get(donor_id)}
+    for donor_id in gaps:
+        checkpoints.hold(donor_id)
+    return gaps
+
+
+async def backfill(gaps: dict[int, int]):
+    """
+    Process the messages posted to the donors while the client was down: the gap after the checkpoint of each
+    donor is fetched from its history and goes through the same pipeline as the new messages, slower than them
+    :param gaps: donor_id -> id of the last message processed before the restart, see hold_backfill
+    """
+    bucket = TokenBucket(Config.backfill_rate, Config.backfill_rate)
+    concurrency = asyncio.Semaphore(Config.backfill_concurrency)
+
+    async def backfill_donor(donor_id: int, min_id: int):
+        async with concurrency:
+            event_states = []
+            try:
+                # the newest messages of the gap, fetched by the pages of 100 messages. The gap ends before the
+                # first live message, the messages from it on are processed live
+                messages = [message async for message in tg_client.iter_messages(
+                    donor_id, min_id=min_id, max_id=checkpoints.first_live(donor_id), limit=Config.backfill_limit)]
+                # and the live messages came while the history was fetched
+                max_id = checkpoints.first_live(donor_id)
+                if max_id:
+                    messages = [message for message in messages if message.id < max_id]
+                messages.reverse()
+                event_states = history_events(messages)
+                if len(event_states):
+                    logging.info(f"backfill of {len(messages)} messages of {donor_id}")
+                for index, event_state in enumerate(event_states):
+                    # the backfill takes only its share of the pipeline, the live messages go on meanwhile
+                    await asyncio.sleep(bucket.delay())
+                    bucket.consume()
+                    event_state.backfill = True
+                    event_state.backfill_last = index == len(event_states) - 1
+                    await pipeline.put(donor_id, event_state)
+            except Exception as e:
+                logging.warning(f"backfill of {donor_id} failed - {str(e)}")
+                event_states = []
+            finally:
+                # otherwise the checkpoint is released by the last message of the backfill
+                if not len(event_states):
+                    checkpoints.release(donor_id)
+
+    await asyncio.gather(*[backfill_donor(donor_id, min_id) for donor_id, min_id in gaps.items()])
+
+
+# bounded queue of the incoming messages and the workers processing them
+pipeline = MessagePipeline(process_event, workers=Config.pipeline_workers, queue_size=Config.pipeline_queue_size)
+# the commands of the control channel, run one by one
+commands = MessagePipeline(control_command, workers=1, queue_size=100)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,100 @@
+import time
+from typing import Any, Awaitable
+
+from database.orm_sqlite3 import CheckpointTable
+from shared.delayed_flush import DelayedFlush
+
+
+class Checkpoints:
+    """
+    The id of the last processed message of each donor, so the messages posted while the client was down are
+    fetched from the history after the restart. The checkpoints are kept in memory and written to the
+    CheckpointTable by one transaction each interval seconds.
+    While the gap of the donor is backfilled, the live messages of the donor don't move its checkpoint, otherwise
+    the restart in the middle of the backfill would skip the rest of the gap. The backfill moves the checkpoint
+    itself and releases the donor when it's done.
+    """
+    def __init__(self, table: CheckpointTable, *, interval: float = 5):
+        """
+        :param table: the table the checkpoints are stored in
+        :param interval: seconds the changed checkpoints are collected for one transaction
+        """
+        self.table = table
+        self.interval = interval
+        self._ids: dict[int, int] = {}
+        self._dirty: set[int] = set()
+        # donor_id -> the biggest id of the live messages processed while the donor is backfilled, 0 if none yet
+        self._held: dict[int, int] = {}
+        # donor_id -> id of the first live message of the donor since the start, the backfill stops before it
+        self._first_live: dict[int, int] = {}
+        self._flusher = DelayedFlush(self._take, delay=interval)
+
+    def get(self, donor_id: int) -> int:
+        """
+        :return: id of the last processed message of the donor, 0 if the donor has no checkpoint
+        """
+        return self._ids.get(donor_id, 0)
+
+    async def load(self):
+        self._ids = await self.table.get_checkpoints()
+
+    def update(self, donor_id: int, msg_id: int, *, backfill: bool = False):
+        """
+        Move the checkpoint of the donor forward
+        :param donor_id: id of the donor chat
+        :param msg_id: id of the processed message
+        :param backfill: True for the messages of the backfill
+        """
+        if not backfill and donor_id in self._held:
+            self._held[donor_id] = max(self._held[donor_id], msg_id)
+            return
+        if msg_id <= self._ids.get(donor_id, 0):
+            return
+        self._ids[donor_id] = msg_id
+        self._dirty.add(donor_id)
+        self._flusher.schedule()
+
+    def hold(self, donor_id: int):
+        """
+        The backfill of the donor starts
+        """
+        self._held.setdefault(donor_id, 0)
+
+    def live(self, donor_id: int, msg_id: int):
+        """
+        The live message of the donor came, the messages from the first one on are processed live and aren't
+        backfilled. The donors are recorded even before they are held, the messages may come before the backfill
+        starts
+        """
+        self._first_live.setdefault(donor_id, msg_id)
+
+    def first_live(self, donor_id: int) -> int:
+        """
+        :return: id of the first live message of the donor since the start, 0 if none came yet
+        """
+        return self._first_live.get(donor_id, 0)
+
+    def release(self, donor_id: int):
+        """
+        The backfill of the donor is done, the live messages processed meanwhile move the checkpoint
+        """
+        live_id = self._held.pop(donor_id, 0)
+        if live_id:
+            self.update(donor_id, live_id)
+
+    async def flush(self):
+        """
+        Write the changed checkpoints at once, waits for the writes started before too
+        """
+        self._flusher.flush()
+        await self._flusher.wait()
+
+    async def stop(self):
+        await self._flusher.stop()
+
+    def _take(self, _key=None) -> Awaitable[Any] or None:
+        dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return None
+        updated = time.time()
+        return self.table.put_checkpoints([(donor_id, self._ids[donor_id], updated) for donor_id in dirty])
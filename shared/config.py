@@ -14,7 +14,59 @@ class Config:
     app_channel_name: str = SECRET.APP_CHANNEL_NAME
 
     database: str = SECRET.APP_DATABASE
+    # count of the threads running the queries, each with its own connection to the database
+    db_workers: int = 2
+    # seconds between the checks of the versions of the rules in the database, the rules changed by any program are
+    # reloaded without the 'reload' command within this time
+    rules_watch_interval: float = 1.0
 
     owner_id: int = SECRET.APP_OWNER_ID
 
     enable_forbidden_content = False
+
+    # LRU cache of the chats and senders metadata, the entities are requested from Telegram again after ttl seconds
+    entity_cache_size: int = 1024
+    entity_cache_ttl: int = 600
+
+    # count of the workers processing the incoming messages and the size of their queue
+    pipeline_workers: int = 4
+    pipeline_queue_size: int = 1000
+
+    # limits of the outgoing requests to Telegram: requests per second and burst size for all the chats and for
+    # each chat separately
+    send_global_rate: float = 25
+    send_global_burst: float = 30
+    send_chat_rate: float = 1
+    send_chat_burst: float = 3
+
+    # how many recipients of one message are served concurrently
+    fanout_concurrency: int = 10
+
+    # opt-in: the messages of the rules with the plain format 'm' (no header) are forwarded by Telegram when it's
+    # allowed, instead of sending their copies; the posts are shown as "Forwarded from" the donor. The messages of one
+    # donor coming within forward_batch_delay seconds are forwarded to the recipient by one request
+    auto_forward: bool = False
+    forward_batch_delay: float = 0.5
+
+    # the rejected messages are listed in the Trash Bin digests, a digest is posted when it gets trash_digest_size
+    # messages or trash_digest_interval seconds after its first message. trash_sample_rate - share of the rejected
+    # messages listed, from 0 to 1
+    trash_digest_size: int = 20
+    trash_digest_interval: float = 60
+    trash_sample_rate: float = 1.0
+
+    # the deliveries are stored in the outbox table by one transaction each outbox_commit_interval seconds, the
+    # failed deliveries are sent again each outbox_retry_interval seconds, the delivery failed outbox_max_attempts
+    # times or left unsent for outbox_pending_ttl seconds isn't sent again
+    outbox_commit_interval: float = 0.05
+    outbox_max_attempts: int = 3
+    outbox_retry_interval: float = 60
+    outbox_pending_ttl: float = 3600
+
+    # the checkpoints (last processed message of each donor) are stored each checkpoint_interval seconds. After the
+    # restart up to backfill_limit messages of each donor posted while the client was down are processed, with
+    # backfill_rate messages per second for all the donors, backfill_concurrency donors at once
+    checkpoint_interval: float = 5
+    backfill_limit: int = 1000
+    backfill_rate: float = 5
+    backfill_concurrency: int = 2
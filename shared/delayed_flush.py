@@ -0,0 +1,76 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+
+
+class DelayedFlush:
+    """
+    The timers of the buffered writers (the outbox, the checkpoints, the forward batches and the Trash Bin digests):
+    the items collected for a key are flushed delay seconds after the first of them, or at once on flush().
+    The writer keeps the items itself and gives the take function, which detaches the collected items of the key
+    and returns the coroutine writing them. The flushes run in the background, the flushes of the same key one
+    after another, in the order they were started.
+    """
+    def __init__(self, take: Callable[[Hashable], Awaitable[Any] or None], *, delay: float):
+        """
+        :param take: function of the key, returns the coroutine writing the collected items, None if there are none
+        :param delay: seconds the items wait for the next ones
+        """
+        self.take = take
+        self.delay = delay
+        self._timers: dict[Hashable, asyncio.Task] = {}
+        # the last started flush of each key, the next flush of the key waits for it
+        self._last: dict[Hashable, asyncio.Task] = {}
+        self._running: set[asyncio.Task] = set()
+
+    def schedule(self, key: Hashable = None):
+        """
+        Flush the key after the delay, if it isn't scheduled already
+        """
+        if key not in self._timers:
+            self._timers[key] = asyncio.create_task(self._flush_later(key))
+
+    def flush(self, key: Hashable = None):
+        """
+        Start the flush of the key at once, doesn't wait for it
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        coroutine = self.take(key)
+        if coroutine is None:
+            return
+        task = asyncio.create_task(self._run(self._last.get(key), coroutine))
+        self._last[key] = task
+        self._running.add(task)
+        task.add_done_callback(lambda done: self._done(key, done))
+
+    async def wait(self):
+        """
+        Wait until all the started flushes are done
+        """
+        while self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def stop(self, keys: Iterable[Hashable] = (None, )):
+        """
+        Flush the keys at once and wait for all the flushes
+        """
+        for key in list(keys):
+            self.flush(key)
+        await self.wait()
+
+    async def _flush_later(self, key: Hashable):
+        await asyncio.sleep(self.delay)
+        self._timers.pop(key, None)
+        self.flush(key)
+
+    @staticmethod
+    async def _run(previous: asyncio.Task or None, coroutine: Awaitable[Any]):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        await coroutine
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        self._running.discard(task)
+        if self._last.get(key) is task:
+            del self._last[key]
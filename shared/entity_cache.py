@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+
+class EntityCache:
+    """
+    LRU cache with time to live for the metadata of the Telegram entities (chats, senders and their admin rights),
+    so the checks of the messages don't cost round-trips to Telegram for each message.
+    """
+    def __init__(self, *, max_size: int = 1024, ttl: float = 600):
+        """
+        :param max_size: maximal count of the entities in cache, the least recently used are dropped first
+        :param ttl: time to live of the entity in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entities: OrderedDict[int, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entities)
+
+    def get(self, key: int) -> Any:
+        """
+        :param key: id of the entity
+        :return: cached entity, or None if it isn't cached or expired
+        """
+        item = self._entities.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, entity = item
+        if expires < time.monotonic():
+            del self._entities[key]
+            self.misses += 1
+            return None
+        self._entities.move_to_end(key)
+        self.hits += 1
+        return entity
+
+    def put(self, key: int, entity: Any):
+        if entity is None:
+            return
+        self._entities[key] = (time.monotonic() + self.ttl, entity)
+        self._entities.move_to_end(key)
+        while len(self._entities) > self.max_size:
+            self._entities.popitem(last=False)
+
+    def invalidate(self, key: int):
+        self._entities.pop(key, None)
+
+    def clear(self):
+        self._entities.clear()
+
+    async def get_or_load(self, key: int, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        :param key: id of the entity
+        :param loader: coroutine function requesting the entity from Telegram, called only on cache miss
+        :return: the entity
+        """
+        entity = self.get(key)
+        if entity is None:
+            entity = await loader()
+            self.put(key, entity)
+        return entity
@@ -43,8 +43,13 @@
 #   9. filter_text = "<list of strings>"
 #      check_filter(text, filter_text) returns True (match 'list of strings')
 #
+import functools
+import re
+
 from younotyou import younotyou as flt
 
+from shared.word_index import WordIndex, TOKENS, WORDS, translate_word_pattern
+
 
 def if_case_sensitive(word: str) -> bool:
     """
@@ -149,6 +154,271 @@ def check_filter(input_text, filter_text: str) -> bool:
     return complied
 
 
+def check_black_list(text: str, black_list: str):
+    """
+    Check each word in text (case-insensitive) and if one found in black list return boolean result
+    :param text: text for checking
+    :param black_list: forbidden list
+    :return: True means that All words in the message have been verified, False - was found
+    """
+    if len(black_list):
+        opt = re.sub(r'[^\w\s]', '', text)  # remove all punctuations from string
+        strings = opt.lower().split()
+        bl_list = black_list.lower().split('|')
+        res = flt(strings, bl_list)
+        if len(res):
+            return False
+    return True
+
+
+def check_or_list(text: str, or_list: str):
+    """
+    (case-insensitive)
+    :param text: text for checking
+    :param or_list: a list of words, at least one of which must be found in the text
+    :return: Returns True if at least one word from the list is found in the text
+    """
+    if len(or_list):
+        opt = re.sub(r'[^\w\s]', '', text)  # remove all punctuations from string
+        strings = opt.lower().split()
+        ors = or_list.lower().split('|')
+        res = flt(strings, ors)
+        return len(res)
+    return True
+
+
+def check_for_and(text: str, and_list: str):
+    """
+    (case-insensitive)
+    :param text: text for checking
+    :param and_list: List of words that must be in the text
+    :return: Returns True if all words from the list are found in the text
+    """
+    if len(and_list):
+        opt = re.sub(r'[^\w\s]', '', text)  # remove all punctuations from string
+        strings = opt.lower().split()
+        and_words_list = and_list.lower().split('+')
+        for and_word in and_words_list:
+            if len(flt(strings, [and_word])) == 0:
+                return False
+    return True
+
+
+class MessageText:
+    """
+    Normalized view of the message text. Each form of the text is computed on first use only and then shared by
+    all the rules checked against this message.
+    """
+    def __init__(self, text: str or None):
+        self.text: str = text or ''
+
+    @functools.cached_property
+    def tokens(self) -> list[str]:
+        # raw words, as check_filter sees them
+        return self.text.split()
+
+    @functools.cached_property
+    def token_set(self) -> frozenset[str]:
+        return frozenset(self.tokens)
+
+    @functools.cached_property
+    def words(self) -> list[str]:
+        # lowercased words without punctuation, as the black, OR and AND lists see them
+        return re.sub(r'[^\w\s]', '', self.text).lower().split()
+
+    @functools.cached_property
+    def word_set(self) -> frozenset[str]:
+        return frozenset(self.words)
+
+    @functools.cached_property
+    def joined_tokens(self) -> str:
+        # the wildcard patterns are searched in the words joined by single spaces
+        return ' '.join(self.tokens)
+
+    @functools.cached_property
+    def joined_words(self) -> str:
+        return ' '.join(self.words)
+
+
+# The functions above parse the filter strings on every call. The classes below do the same work once, when the
+# rules are loaded: the patterns of the rules are registered in a WordIndex, each rule keeps only the ids of its
+# words, and checking a message against a rule is a set operation over the ids found in the message by one scan.
+
+class CompiledFilter:
+    """
+    The filter string (see the format description at the top of this file) compiled once.
+    CompiledFilter(filter_text, index).matches(index.scan(MessageText(text))) returns the same result as
+    check_filter(text, filter_text)
+    """
+    __slots__ = ("match_all", "flags_and", "flags_or", "and_should_be", "and_should_not_be", "or_should_be")
+
+    def __init__(self, filter_text: str, index: WordIndex):
+        self.match_all = filter_text == '*'
+        self.flags_and = False
+        self.flags_or = False
+        self.and_should_be: frozenset[int] = frozenset()
+        self.and_should_not_be: frozenset[int] = frozenset()
+        self.or_should_be: frozenset[int] = frozenset()
+        if self.match_all:
+            return
+
+        conditions_and = []
+        conditions_or = []
+        for item in filter_text.split(' | '):
+            if item.find(' & ') >= 0:
+                self.flags_and = True
+                conditions_and.extend(item.split(' & '))
+            else:
+                self.flags_or = True
+                conditions_or.append(item)
+
+        # check_filter takes the case sensitivity of both parts of the filter from the AND conditions
+        case_sensitive = build_case_sensitive_flag(conditions_and)
+        if self.flags_and:
+            self.and_should_be = frozenset(index.add(c, TOKENS, case_sensitive)
+                                           for c in conditions_and if not c.startswith('!'))
+            self.and_should_not_be = frozenset(index.add(c.removeprefix('!'), TOKENS, case_sensitive)
+                                               for c in conditions_and if c.startswith('!'))
+        if self.flags_or:
+            # the negative OR conditions are ignored by check_filter
+            self.or_should_be = frozenset(index.add(c, TOKENS, case_sensitive)
+                                          for c in conditions_or if not c.startswith('!'))
+
+    def matches(self, hits: set[int]) -> bool:
+        """
+        :param hits: word ids found in the text under study by WordIndex.scan
+        :return: True, if the text complies with the filter
+        """
+        if self.match_all:
+            return True
+        if self.flags_and and self.and_should_be <= hits and self.and_should_not_be.isdisjoint(hits):
+            return True
+        return self.flags_or and not self.or_should_be.isdisjoint(hits)
+
+    def required_words(self) -> frozenset[int] or None:
+        """
+        :return: ids of the words at least one of which must be found in the text to comply with the filter,
+        None if the filter may be complied without positive words ('*' or only negative AND conditions)
+        """
+        if self.match_all:
+            return None
+        required = set()
+        if self.flags_and:
+            if not self.and_should_be:
+                return None
+            # any of the AND words is enough, all of them must be found anyway
+            required.add(min(self.and_should_be))
+        if self.flags_or:
+            required.update(self.or_should_be)
+        return frozenset(required)
+
+    def words(self) -> frozenset[int]:
+        """
+        :return: ids of all the words of the filter
+        """
+        return self.and_should_be | self.and_should_not_be | self.or_should_be
+
+
+class RuleMatcher:
+    """
+    All text conditions of a rule (filter, black_list, and_list, or_list) compiled once when the rules are loaded.
+    """
+    __slots__ = ("filter", "black_list", "and_list", "or_list", "required")
+
+    def __init__(self, index: WordIndex, rule_filter: str, black_list: str = '', and_list: str = '',
+                 or_list: str = ''):
+        self.filter = CompiledFilter(rule_filter, index)
+        self.black_list = frozenset(index.add(word, WORDS) for word in black_list.lower().split('|')) \
+            if len(black_list) else None
+        self.and_list = frozenset(index.add(word, WORDS) for word in and_list.lower().split('+')) \
+            if len(and_list) else frozenset()
+        self.or_list = frozenset(index.add(word, WORDS) for word in or_list.lower().split('|')) \
+            if len(or_list) else None
+
+        # The rule can't accept a message without at least one of these words, so the rule is indexed by them
+        # and isn't checked at all when none of them is found in the message. None - the rule must be always checked
+        self.required: frozenset[int] or None = None
+        candidates = [self.or_list, self.filter.required_words()]
+        if len(self.and_list):
+            candidates.append(frozenset([min(self.and_list)]))
+        for words in candidates:
+            if words is not None and (self.required is None or len(words) < len(self.required)):
+                self.required = words
+
+    def check_black_list(self, hits: set[int]) -> bool:
+        return self.black_list is None or self.black_list.isdisjoint(hits)
+
+    def check_or_list(self, hits: set[int]) -> bool:
+        return self.or_list is None or not self.or_list.isdisjoint(hits)
+
+    def check_for_and(self, hits: set[int]) -> bool:
+        return self.and_list <= hits
+
+    def check_filter(self, hits: set[int]) -> bool:
+        return self.filter.matches(hits)
+
+    def words(self) -> frozenset[int]:
+        """
+        :return: ids of all the words of the rule registered in the index
+        """
+        return self.filter.words() | (self.black_list or frozenset()) | self.and_list | (self.or_list or frozenset())
+
+
+def compile_rule(rule, index: WordIndex) -> RuleMatcher:
+    """
+    :param rule: rule loaded from the RulesTable
+    :param index: dictionary shared by all the rules, the words of the rule are registered there
+    :return: matcher object with precompiled text conditions of the rule
+    """
+    return RuleMatcher(index, rule.filter, rule.black_list, rule.and_list, rule.or_list)
+
+
+class Censor:
+    """
+    The black list of a bleeping rule compiled into one case-insensitive regular expression, which finds and bleeps
+    all the forbidden words of the text in a single pass.
+    The black list is a list of words separated by '|', the words may contain wildcards ('fu*'), the words
+    beginning with '!' are never bleeped ('!fun').
+    """
+    __slots__ = ("symbol", "pattern", "exclude")
+
+    def __init__(self, black_list: str, symbol: str):
+        self.symbol = symbol
+        self.pattern: re.Pattern or None = None
+        self.exclude: re.Pattern or None = None
+        words = [word.strip() for word in black_list.split('|')]
+        # the words of wildcards only ('*') match anything, even the empty string, they don't define forbidden words
+        should_be = [translate_word_pattern(w, r'\w') for w in words
+                     if len(w.strip('*')) and not w.startswith('!')]
+        should_not_be = [translate_word_pattern(w.removeprefix('!'), r'\w') for w in words if w.startswith('!')]
+        if len(should_be):
+            self.pattern = re.compile(rf"(?<!\w)(?:{'|'.join(should_be)})(?!\w)", re.IGNORECASE)
+        if len(should_not_be):
+            self.exclude = re.compile(rf"(?:{'|'.join(should_not_be)})", re.IGNORECASE)
+
+    def bleep(self, text: str) -> tuple[str, int]:
+        """
+        :param text: text of the message
+        :return: the text with the forbidden words replaced by the bleep symbols and count of the bleeped words
+        """
+        if self.pattern is None or not len(text):
+            return text, 0
+        hits = 0
+
+        def replace(match: re.Match) -> str:
+            nonlocal hits
+            word = match.group()
+            # the empty matches between the non-word characters aren't words
+            if not len(word):
+                return word
+            if self.exclude is not None and self.exclude.fullmatch(word):
+                return word
+            hits += 1
+            return len(word) * self.symbol
+
+        return self.pattern.sub(replace, text), hits
+
+
 if __name__ == '__main__':
     text = "Test skip everything functionality like test"
     filter_str = "every* & like"
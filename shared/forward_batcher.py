@@ -0,0 +1,82 @@
+import logging
+from typing import Any, Awaitable, Callable
+
+from shared.delayed_flush import DelayedFlush
+from shared.send_scheduler import SendScheduler
+
+
+class ForwardBatcher:
+    """
+    Server side forwarding of the messages: Telegram copies the message (with its media) itself, so the bytes of
+    the media don't go through the client again. The messages of one donor forwarded to the same recipient during
+    a short delay are collected and forwarded by one request, so a burst of posts (an album, for example) costs
+    one call instead of one call per message.
+    forward() doesn't wait for the request: the message processing of the donor goes on, and the next messages of
+    the burst join the same batch. The forwarded batches are passed to the on_sent callback and the failed ones to
+    the on_error callback.
+    """
+    # Telegram forwards up to 100 messages by one request
+    MAX_BATCH = 100
+
+    def __init__(self, scheduler: SendScheduler, *, delay: float = 0.5, max_batch: int = MAX_BATCH,
+                 on_sent: Callable[[int, int, list[int]], Any] or None = None,
+                 on_error: Callable[[int, int, list[int], Exception], Awaitable[Any]] or None = None):
+        """
+        :param scheduler: the forward requests are sent through the scheduler
+        :param delay: seconds the batch waits for the next messages of the burst
+        :param max_batch: the batch is forwarded at once when it gets this count of messages
+        :param on_sent: function (recipient id, donor id, message ids) called when the batch is forwarded
+        :param on_error: coroutine function (recipient id, donor id, message ids, exception) called when the batch
+                         couldn't be forwarded
+        """
+        self.scheduler = scheduler
+        self.delay = delay
+        self.max_batch = min(max(1, max_batch), self.MAX_BATCH)
+        self.on_sent = on_sent
+        self.on_error = on_error
+        self.forwarded = 0
+        self.requests = 0
+        # (recipient id, donor id) -> ids of the messages waiting to be forwarded
+        self._batches: dict[tuple[int, int], list[int]] = {}
+        self._flusher = DelayedFlush(self._take, delay=delay)
+        self._logger = logging.getLogger(__name__)
+
+    def forward(self, chat_id: int, message_ids: list[int], from_peer: int):
+        """
+        Add the messages to the batch of the recipient
+        :param chat_id: id of the recipient chat
+        :param message_ids: ids of the messages in the donor chat, the messages of an album are added together, so
+                            they are forwarded by the same request and stay grouped
+        :param from_peer: id of the donor chat
+        """
+        key = (chat_id, from_peer)
+        batch = self._batches.setdefault(key, [])
+        batch.extend(message_id for message_id in message_ids if message_id not in batch)
+        if len(batch) >= self.max_batch:
+            self._flusher.flush(key)
+        else:
+            self._flusher.schedule(key)
+
+    async def stop(self):
+        """
+        Forward all the collected messages at once and wait for the requests
+        """
+        await self._flusher.stop(self._batches)
+
+    def _take(self, key: tuple[int, int]) -> Awaitable[Any] or None:
+        message_ids = self._batches.pop(key, None)
+        return self._send(key, message_ids) if message_ids else None
+
+    async def _send(self, key: tuple[int, int], message_ids: list[int]):
+        chat_id, from_peer = key
+        try:
+            await self.scheduler.forward_messages(chat_id, message_ids, from_peer)
+            self.requests += 1
+            self.forwarded += len(message_ids)
+            if self.on_sent is not None:
+                self.on_sent(chat_id, from_peer, message_ids)
+        except Exception as e:
+            self._logger.warning(f"forwarding of {len(message_ids)} messages from {from_peer} to {chat_id} "
+                                 f"failed: {str(e)}")
+            if self.on_error is not None:
+                await self.on_error(chat_id, from_peer, message_ids, e)
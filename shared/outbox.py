@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable
+
+from database.orm_sqlite3 import OutboxTable
+from shared.delayed_flush import DelayedFlush
+
+
+class Outbox:
+    """
+    Durable queue of the deliveries: each rendered delivery of a matched message is stored in the OutboxTable before
+    it's sent and marked sent after that, so the deliveries interrupted by a crash or a restart are sent again when
+    the client starts (at least once delivery). A delivery is keyed by (donor_id, msg_id, recip_id), the same
+    message is never queued for the same recipient twice.
+    The deliveries being sent are kept in memory, so pending returns only the deliveries left unsent: the ones of
+    the previous run and the ones failed during this run, which are sent again periodically.
+    The writes are grouped: the deliveries added during the interval are written by one transaction and the statuses
+    changed during it by another one, so the message processing doesn't wait for a commit per message.
+    """
+    def __init__(self, table: OutboxTable, *, interval: float = 0.05, max_attempts: int = 3,
+                 pending_ttl: float = 3600, keep: float = 86400):
+        """
+        :param table: the table the deliveries are stored in
+        :param interval: seconds the writes are collected for one transaction
+        :param max_attempts: the delivery failed this count of times isn't sent again
+        :param pending_ttl: the delivery left unsent for this count of seconds gets the FAILED status
+        :param keep: seconds the sent and failed deliveries are kept in the table
+        """
+        self.table = table
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.pending_ttl = pending_ttl
+        self.keep = keep
+        self.added = 0
+        self.duplicates = 0
+        self.commits = 0
+        self._new: list[tuple[dict[str, Any], asyncio.Future]] = []
+        self._sent: list[tuple[int, int, int]] = []
+        self._failed: list[tuple[int, int, int]] = []
+        self._flusher = DelayedFlush(self._take, delay=interval)
+        # the deliveries being sent, they aren't returned by pending
+        self._in_flight: set[tuple[int, int, int]] = set()
+        self._logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def key(entry: dict[str, Any] or Any) -> tuple[int, int, int]:
+        if isinstance(entry, dict):
+            return entry["donor_id"], entry["msg_id"], entry["recip_id"]
+        return entry.donor_id, entry.msg_id, entry.recip_id
+
+    async def add(self, entries: list[dict[str, Any]]) -> list[bool]:
+        """
+        Store the deliveries, waits for the transaction they are written by
+        :param entries: the deliveries, see OutboxTable
+        :return: for each delivery, True if it has to be sent, False if it was queued already
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        claimed = []
+        for entry in entries:
+            entry.setdefault("status", OutboxTable.PENDING)
+            entry.setdefault("created", time.time())
+            future = loop.create_future()
+            self._new.append((entry, future))
+            futures.append(future)
+            # the delivery is in flight as soon as it's written, before this coroutine is resumed
+            key = self.key(entry)
+            claimed.append(key not in self._in_flight)
+            self._in_flight.add(key)
+        self._flusher.schedule()
+        try:
+            added = list(await asyncio.gather(*futures))
+        except BaseException:
+            for entry, is_claimed in zip(entries, claimed):
+                if is_claimed:
+                    self._in_flight.discard(self.key(entry))
+            raise
+        for entry, is_claimed, is_added in zip(entries, claimed, added):
+            if is_claimed and not is_added:
+                self._in_flight.discard(self.key(entry))
+        return added
+
+    def done(self, donor_id: int, msg_id: int, recip_id: int):
+        """
+        Mark the delivery sent
+        """
+        self._sent.append((donor_id, msg_id, recip_id))
+        self._in_flight.discard((donor_id, msg_id, recip_id))
+        self._flusher.schedule()
+
+    def failed(self, donor_id: int, msg_id: int, recip_id: int):
+        """
+        Count the failed attempt of the delivery, after max_attempts the delivery isn't sent again
+        """
+        self._failed.append((donor_id, msg_id, recip_id))
+        self._in_flight.discard((donor_id, msg_id, recip_id))
+        self._flusher.schedule()
+
+    async def pending(self) -> list[Any]:
+        """
+        Take the deliveries to send again: the ones left unsent by the previous run of the client and the ones failed
+        during this run. The deliveries pending longer than pending_ttl get the FAILED status, the old sent and failed
+        ones are dropped. The returned deliveries are in flight until they are reported done or failed
+        :return: the deliveries
+        """
+        await self.flush()
+        now = time.time()
+        await self.table.expire_pending(now - self.pending_ttl)
+        await self.table.delete_done(now - self.keep)
+        entries = [entry for entry in await self.table.get_pending() if self.key(entry) not in self._in_flight]
+        self._in_flight.update(self.key(entry) for entry in entries)
+        return entries
+
+    async def flush(self):
+        """
+        Write all the collected changes at once, waits for the writes started before too
+        """
+        self._flusher.flush()
+        await self._flusher.wait()
+
+    async def stop(self):
+        await self._flusher.stop()
+
+    def _take(self, _key=None) -> Awaitable[Any] or None:
+        new, self._new = self._new, []
+        sent, self._sent = self._sent, []
+        failed, self._failed = self._failed, []
+        if not new and not sent and not failed:
+            return None
+        return self._write(new, sent, failed)
+
+    async def _write(self, new: list[tuple[dict[str, Any], asyncio.Future]], sent: list[tuple[int, int, int]],
+                     failed: list[tuple[int, int, int]]):
+        try:
+            if new:
+                added = await self.table.add_entries([entry for entry, _ in new])
+                for (_, future), is_added in zip(new, added):
+                    if is_added:
+                        self.added += 1
+                    else:
+                        self.duplicates += 1
+                    if not future.done():
+                        future.set_result(is_added)
+            if sent or failed:
+                await self.table.update_entries(sent, failed, self.max_attempts)
+            self.commits += 1
+        except Exception as e:
+            self._logger.exception("outbox write failed")
+            for _, future in new:
+                if not future.done():
+                    future.set_exception(e)
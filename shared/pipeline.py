@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+
+class MessagePipeline:
+    """
+    Bounded queue of the incoming messages served by several worker tasks, so the event handler only enqueues the
+    message and slow sending of one message doesn't stall the intake of the next ones.
+    The messages with the same key (donor id) always go to the same worker, so they are processed in the order
+    they came in. When the queue of the worker is full, put() waits until there is room (backpressure). The items put
+    before start() wait in the queues, so the messages coming while the rules are loaded aren't lost.
+    """
+    def __init__(self, handler: Callable[[Any], Awaitable[Any]], *, workers: int = 4, queue_size: int = 1000):
+        """
+        :param handler: coroutine function that processes one item
+        :param workers: count of the worker tasks (concurrency)
+        :param queue_size: maximal count of the waiting items, shared equally between the workers
+        """
+        self.handler = handler
+        self.workers_count = max(1, workers)
+        self.queue_size = max(1, queue_size // self.workers_count)
+        self.processed = 0
+        self.failed = 0
+        self._queues: list[asyncio.Queue] = []
+        self._workers: list[asyncio.Task] = []
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def running(self) -> bool:
+        return len(self._workers) > 0
+
+    def qsize(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def _create_queues(self):
+        if not self._queues:
+            self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers_count)]
+
+    def start(self):
+        if self.running:
+            return
+        self._create_queues()
+        self._workers = [asyncio.create_task(self._worker(queue), name=f'pipeline-worker-{index}')
+                         for index, queue in enumerate(self._queues)]
+
+    async def put(self, key: int, item: Any):
+        """
+        Enqueue the item, waits while the queue of the worker is full. Before start() the item waits in the queue
+        :param key: items with the same key are processed by the same worker in order
+        :param item: item passed to the handler
+        """
+        self._create_queues()
+        await self._queues[hash(key) % self.workers_count].put(item)
+
+    async def stop(self):
+        """
+        Wait until all the enqueued items are processed and stop the workers
+        """
+        if not self.running:
+            return
+        for queue in self._queues:
+            await queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queues = []
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            try:
+                await self.handler(item)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                self._logger.exception("message processing failed")
+            finally:
+                queue.task_done()
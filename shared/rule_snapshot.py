@@ -0,0 +1,179 @@
+import copy
+from collections import namedtuple
+from typing import Any
+
+from shared.filter_by_parameters import Censor, RuleMatcher, compile_rule
+from shared.word_index import WordIndex
+
+TrashBin = namedtuple("TrashBin", ["name", "id", "status", "uid"], defaults=['', 0, '', 0])
+
+
+def rule_conditions(rule) -> tuple[str, str, str, str]:
+    """
+    :return: the text conditions of the rule, the compiled matcher depends only on them
+    """
+    return rule.filter, rule.black_list, rule.and_list, rule.or_list
+
+
+class RuleSnapshot:
+    """
+    The rules and the bleeping rules loaded from the database, together with their indexes and compiled text
+    conditions. The snapshot isn't changed after it's built: the reload builds the next snapshot beside the current
+    one and publishes it by one reference swap, so the messages see either the old or the new rules, never an empty
+    or a half-built set. Each message takes the current snapshot once and uses it till the end of its processing.
+    The next snapshot is built incrementally: the rules with the same text conditions as a rule of the previous
+    snapshot take its compiled matcher (the censor of the same black list and symbol for the bleeping rules), only
+    the new and changed conditions are compiled. The rules are matched by their content, not by uid, because the
+    import of the CSV file stores all the rules anew with the new uids.
+    """
+    __slots__ = ("version", "all_rules", "rules", "bleeps", "rules_by_uid", "bleeps_by_uid",
+                 "rules_by_donor", "bleeps_by_donor", "rule_matchers", "bleep_censors", "rule_words",
+                 "rules_by_word", "always_checked", "recip_list", "trash_bin", "compiled", "reused")
+
+    def __init__(self, rules: list or tuple = (), bleeps: list or tuple = (), *, previous: 'RuleSnapshot' = None):
+        """
+        :param rules: all the rules loaded from the RulesTable, including the Trash Bin
+        :param bleeps: the rules loaded from the BleepTable
+        :param previous: the current snapshot, its compiled rules are reused
+        """
+        self.version: int = previous.version + 1 if previous is not None else 0
+        self.all_rules: tuple = tuple(rules)
+        self.rules: tuple = ()                                  # all the rules except the Trash Bin
+        self.bleeps: tuple = tuple(bleeps)
+        self.rules_by_uid: dict[int, Any] = {rule.uid: rule for rule in self.all_rules}
+        self.bleeps_by_uid: dict[int, Any] = {rule.uid: rule for rule in self.bleeps}
+        self.rules_by_donor: dict[int, list] = {}               # donor_id -> active rules
+        self.bleeps_by_donor: dict[int, list] = {}              # donor_id -> bleeping rules
+        self.rule_matchers: dict[int, RuleMatcher] = {}         # rule uid -> compiled text conditions of the rule
+        self.bleep_censors: dict[int, Censor] = {}              # bleeping rule uid -> compiled black list
+        self.rule_words = WordIndex()                           # words of all the active rules
+        # inverted index of the rules by the words they require (see RuleMatcher.required), the positions of the
+        # rules refer to their lists in rules_by_donor
+        self.rules_by_word: dict[int, dict[int, list[int]]] = {}    # donor_id -> word id -> positions of the rules
+        self.always_checked: dict[int, list[int]] = {}             # donor_id -> positions of the rules without
+                                                                   # required words
+        self.recip_list: frozenset[int] = frozenset(rule.recip_id for rule in self.all_rules)
+        self.trash_bin = TrashBin()
+        self.compiled = 0       # count of the rules compiled for this snapshot
+        self.reused = 0         # count of the rules taken from the previous snapshot
+        self._build_rules(previous)
+        self._build_bleeps(previous)
+
+    def _build_rules(self, previous: 'RuleSnapshot' or None):
+        # text conditions of the rule -> compiled matcher of the previous snapshot
+        matchers: dict[tuple, RuleMatcher] = {}
+        if previous is not None:
+            matchers = {rule_conditions(previous.rules_by_uid[uid]): matcher
+                        for uid, matcher in previous.rule_matchers.items()}
+            # the word ids of the reused matchers refer to the index of the previous snapshot, so its copy is
+            # extended. The words of the removed and changed rules stay in the copy, so the index is built anew
+            # when they prevail
+            live_words = set()
+            for rule in self.all_rules:
+                matcher = matchers.get(rule_conditions(rule))
+                if matcher is not None:
+                    live_words.update(matcher.words())
+            if len(previous.rule_words) <= 2 * len(live_words) + 64:
+                self.rule_words = previous.rule_words.copy()
+            else:
+                matchers = {}
+
+        rules = []
+
+        for rule in self.all_rules:
+            if rule.title == '__trash_bin__':
+                self.trash_bin = TrashBin(rule.recip_name, rule.recip_id, rule.status, rule.uid)
+                continue
+
+            rules.append(rule)
+            if rule.status != 'active':
+                continue
+            donor_rules = self.rules_by_donor.setdefault(rule.donor_id, [])
+            position = len(donor_rules)
+            donor_rules.append(rule)
+            conditions = rule_conditions(rule)
+            matcher = matchers.get(conditions)
+            if matcher is not None:
+                self.reused += 1
+            else:
+                matcher = compile_rule(rule, self.rule_words)
+                matchers[conditions] = matcher
+                self.compiled += 1
+            self.rule_matchers[rule.uid] = matcher
+            if matcher.required is None:
+                self.always_checked.setdefault(rule.donor_id, []).append(position)
+            else:
+                by_word = self.rules_by_word.setdefault(rule.donor_id, {})
+                for word_id in matcher.required:
+                    by_word.setdefault(word_id, []).append(position)
+        self.rules = tuple(rules)
+        # the snapshot is built by a worker thread, the messages only read the index
+        self.rule_words.compile()
+
+    def _build_bleeps(self, previous: 'RuleSnapshot' or None):
+        # (black list, symbol) -> censor of the previous snapshot
+        censors: dict[tuple[str, str], Censor] = {}
+        if previous is not None:
+            censors = {(previous.bleeps_by_uid[uid].black_list, previous.bleeps_by_uid[uid].bleep_symbol): censor
+                       for uid, censor in previous.bleep_censors.items()}
+        for rule in self.bleeps:
+            self.bleeps_by_donor.setdefault(rule.donor_id, []).append(rule)
+            key = (rule.black_list, rule.bleep_symbol)
+            censor = censors.get(key)
+            if censor is None:
+                censor = censors[key] = Censor(rule.black_list, rule.bleep_symbol)
+            self.bleep_censors[rule.uid] = censor
+
+    def with_rules(self, rules: list or tuple) -> 'RuleSnapshot':
+        """
+        :return: the next snapshot with the new rules and the same bleeping rules
+        """
+        return RuleSnapshot(rules, self.bleeps, previous=self)
+
+    def with_bleeps(self, bleeps: list or tuple) -> 'RuleSnapshot':
+        """
+        :return: the next snapshot with the same rules and the new bleeping rules
+        """
+        return RuleSnapshot(self.all_rules, bleeps, previous=self)
+
+    def with_trash_bin_status(self, status: str) -> 'RuleSnapshot':
+        """
+        :return: the next snapshot with the Trash Bin enabled ('active') or disabled, everything else is shared
+        """
+        snapshot = copy.copy(self)
+        snapshot.version = self.version + 1
+        snapshot.trash_bin = self.trash_bin._replace(status=status)
+        # the next snapshots are built from all_rules, so the Trash Bin rule is replaced there too
+        rule = self.rules_by_uid.get(self.trash_bin.uid)
+        if rule is not None:
+            rule = rule._replace(status=status)
+            snapshot.all_rules = tuple(rule if other.uid == rule.uid else other for other in self.all_rules)
+            snapshot.rules_by_uid = {**self.rules_by_uid, rule.uid: rule}
+        snapshot.compiled = 0
+        snapshot.reused = len(self.rule_matchers)
+        return snapshot
+
+    def donors(self) -> set[int]:
+        """
+        :return: ids of the chats the messages of which are checked by the active rules or bleeped
+        """
+        return set(self.rules_by_donor) | set(self.bleeps_by_donor)
+
+    def candidate_rules(self, donor_id: int, hits: set[int]) -> list:
+        """
+        Select the rules of the donor, that can accept the message, using the inverted index of the required words
+        :param donor_id: id of the chat the message came from
+        :param hits: word ids found in the message
+        :return: the rules in their original order
+        """
+        rules = self.rules_by_donor.get(donor_id, [])
+        positions = set(self.always_checked.get(donor_id, []))
+        by_word = self.rules_by_word.get(donor_id, {})
+        if len(hits) < len(by_word):
+            for word_id in hits:
+                positions.update(by_word.get(word_id, []))
+        else:
+            for word_id, word_positions in by_word.items():
+                if word_id in hits:
+                    positions.update(word_positions)
+        return [rules[position] for position in sorted(positions)]
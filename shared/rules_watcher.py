@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from database.orm_sqlite3 import VersionTable
+
+
+class RulesWatcher:
+    """
+    Reloads the rules when they are changed in the database by any program, the external bot included, without a
+    command in the control channel. The triggers of the rule tables increase their versions in the VersionTable on
+    each change, and the watcher reads the versions each interval seconds: one lookup of two rows, so the changes
+    take effect within the interval at almost no cost. A failed read or reload is logged and the watcher goes on.
+    The loaders report the version they have read the rules at (see loaded), so the changes made by the client
+    itself and reloaded already aren't reloaded again.
+    """
+    def __init__(self, table: VersionTable, on_change: Callable[[set[str]], Awaitable[Any]], *,
+                 interval: float = 1.0):
+        """
+        :param table: the versions of the rule tables
+        :param on_change: coroutine function reloading the changed tables, gets their names
+        :param interval: seconds between the reads of the versions
+        """
+        self.table = table
+        self.on_change = on_change
+        self.interval = interval
+        self.reloads = 0
+        # name of the table -> the version the client has loaded
+        self._loaded: dict[str, int] = {}
+        self._task: asyncio.Task or None = None
+        self._logger = logging.getLogger(__name__)
+
+    async def version(self, name: str) -> int:
+        """
+        :return: the current version of the table, read it before the rows
+        """
+        return (await self.table.get_versions()).get(name, 0)
+
+    def loaded(self, name: str, version: int):
+        """
+        The rules of the table were loaded at the version
+        """
+        self._loaded[name] = version
+
+    def changed_row(self, name: str, before: int, after: int):
+        """
+        The client has changed one row of the table itself and applied the change to its rules already. The triggers
+        count one change for the row, so the version after it is taken as loaded only if it's the next one after the
+        loaded version, the changes made by anyone else meanwhile are reloaded
+        :param before: the version read before the change
+        :param after: the version read after the change
+        """
+        if self._loaded.get(name) == before and after == before + 1:
+            self._loaded[name] = after
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._poll()
+            except Exception as e:
+                # the database may be locked or unavailable for a while, the next poll tries again
+                self._logger.warning(f"check of the rule versions failed: {str(e)}")
+
+    async def _poll(self):
+        versions = await self.table.get_versions()
+        changed = {name for name, version in versions.items()
+                   if name in self._loaded and version != self._loaded[name]}
+        if not changed:
+            return
+        self.reloads += 1
+        try:
+            await self.on_change(changed)
+        except Exception as e:
+            # the previous rules stay, the next poll tries to reload them again
+            self._logger.warning(f"reload of the changed rules failed: {str(e)}")
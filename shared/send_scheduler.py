@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from telethon import TelegramClient, errors
+
+
+class TokenBucket:
+    """
+    Classic token bucket: the tokens are added with the constant rate up to the capacity, each request takes one
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """
+        :return: seconds until the token is available, 0 if it's available now
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class SendScheduler:
+    """
+    All the outgoing requests to Telegram (send, forward, edit, delete) go through this scheduler.
+    Each recipient chat has its own queue served by its own task and its own token bucket, and all of them share
+    the global token bucket. FloodWaitError parks only the queue of the chat it was received for, the request is
+    repeated after the required time. The requests with a higher priority (a lower number) get the global tokens
+    first, so the replies to the control channel jump the line.
+    """
+    PRIORITY_CONTROL = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    def __init__(self, client: TelegramClient, *, control_chat_id: int = 0,
+                 global_rate: float = 25, global_burst: float = 30,
+                 chat_rate: float = 1, chat_burst: float = 3,
+                 flood_retries: int = 3):
+        """
+        :param client: telegram client
+        :param control_chat_id: requests to this chat get PRIORITY_CONTROL by default
+        :param global_rate: requests per second for all the chats
+        :param global_burst: count of requests that may be sent at once after the idle time
+        :param chat_rate: requests per second for one chat
+        :param chat_burst: count of requests to one chat that may be sent at once after the idle time
+        :param flood_retries: how many times the request is repeated after FloodWaitError
+        """
+        self.client = client
+        self.control_chat_id = control_chat_id
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.flood_retries = flood_retries
+        self.sent = 0
+        self.flood_waits = 0
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._queues: dict[int, asyncio.PriorityQueue] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self._sequence = itertools.count()
+        self._waiters: list[tuple[int, int]] = []
+        self._turn: asyncio.Condition or None = None
+        self._logger = logging.getLogger(__name__)
+
+    async def call(self, chat_id: int, request: Callable[..., Awaitable[Any]], *args,
+                   priority: int or None = None, **kwargs) -> Any:
+        """
+        Schedule the request to the chat and wait for its result
+        :param chat_id: id of the chat the request is addressed to
+        :param request: coroutine function of the client, such as client.send_message
+        :param priority: PRIORITY_CONTROL, PRIORITY_NORMAL or PRIORITY_LOW
+        :return: the result of the request
+        """
+        if priority is None:
+            priority = self.PRIORITY_CONTROL if chat_id == self.control_chat_id else self.PRIORITY_NORMAL
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.PriorityQueue()
+        queue.put_nowait((priority, next(self._sequence), request, args, kwargs, future))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id, queue))
+        return await future
+
+    async def send_message(self, chat_id: int, *args, priority: int or None = None, **kwargs) -> Any:
+        return await self.call(chat_id, self.client.send_message, chat_id, *args, priority=priority, **kwargs)
+
+    async def send_file(self, chat_id: int, *args, priority: int or None = None, **kwargs) -> Any:
+        return await self.call(chat_id, self.client.send_file, chat_id, *args, priority=priority, **kwargs)
+
+    async def forward_messages(self, chat_id: int, *args, priority: int or None = None, **kwargs) -> Any:
+        return await self.call(chat_id, self.client.forward_messages, chat_id, *args, priority=priority, **kwargs)
+
+    async def edit_message(self, chat_id: int, *args, priority: int or None = None, **kwargs) -> Any:
+        return await self.call(chat_id, self.client.edit_message, chat_id, *args, priority=priority, **kwargs)
+
+    async def delete_messages(self, chat_id: int, *args, priority: int or None = None, **kwargs) -> Any:
+        return await self.call(chat_id, self.client.delete_messages, chat_id, *args, priority=priority, **kwargs)
+
+    async def stop(self):
+        """
+        Wait until all the scheduled requests are sent
+        """
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def _chat_worker(self, chat_id: int, queue: asyncio.PriorityQueue):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        future = None
+        try:
+            while not queue.empty():
+                priority, sequence, request, args, kwargs, future = queue.get_nowait()
+                retries = 0
+                while not future.done():
+                    await asyncio.sleep(bucket.delay())
+                    bucket.consume()
+                    await self._acquire_global(priority)
+                    if future.done():
+                        # the caller doesn't wait for the result anymore
+                        break
+                    try:
+                        result = await request(*args, **kwargs)
+                        self.sent += 1
+                        if not future.done():
+                            future.set_result(result)
+                    except errors.FloodWaitError as e:
+                        self.flood_waits += 1
+                        if retries >= self.flood_retries:
+                            if not future.done():
+                                future.set_exception(e)
+                            break
+                        retries += 1
+                        # park only this chat, the requests to the other chats go on
+                        self._logger.warning(f"FloodWait {e.seconds}s for chat {chat_id}")
+                        await asyncio.sleep(e.seconds + 1)
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            self._workers.pop(chat_id, None)
+            self._queues.pop(chat_id, None)
+            # the worker may be cancelled only on exit, the requests waiting for it are cancelled too
+            if future is not None and not future.done():
+                future.cancel()
+            while not queue.empty():
+                queue.get_nowait()[-1].cancel()
+
+    async def _acquire_global(self, priority: int):
+        """
+        Take the token of the global bucket, the waiting requests get it in the order of their priority
+        """
+        if self._turn is None:
+            self._turn = asyncio.Condition()
+        entry = (priority, next(self._sequence))
+        async with self._turn:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    await self._turn.wait_for(lambda: self._waiters[0] == entry)
+                    delay = self._global_bucket.delay()
+                    if delay <= 0:
+                        self._global_bucket.consume()
+                        return
+                    # release the turn while waiting for the token, a more urgent request may come meanwhile
+                    try:
+                        await asyncio.wait_for(self._turn.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._turn.notify_all()
@@ -0,0 +1,102 @@
+import logging
+import random
+from typing import Any, Awaitable, Callable
+
+from shared.delayed_flush import DelayedFlush
+
+# Telegram doesn't accept the text messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TrashDigest:
+    """
+    Buffered sink of the Trash Bin: instead of a copy of each rejected message, the Trash Bin gets compact digest
+    posts, each listing many rejected messages with the link to the original message, all the reasons it was
+    rejected for and the beginning of its text. The same message added several times is listed once with the
+    reasons merged. The digest is posted when it collects max_entries messages or interval seconds after its first
+    message, whichever comes first. With sample_rate below 1 only that share of the rejected messages is listed.
+    """
+    def __init__(self, send: Callable[[int, str], Awaitable[Any]], *, max_entries: int = 20, interval: float = 60,
+                 sample_rate: float = 1.0, preview_length: int = 200):
+        """
+        :param send: coroutine function (chat id, text) posting the digest
+        :param max_entries: count of the messages the digest is posted at
+        :param interval: seconds the digest waits for the next messages
+        :param sample_rate: share of the rejected messages listed in the digests, from 0 to 1
+        :param preview_length: count of the characters of the text of the message listed in the digest
+        """
+        self.send = send
+        self.max_entries = max(1, max_entries)
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.preview_length = preview_length
+        self.added = 0
+        self.skipped = 0
+        self.posted = 0
+        # Trash Bin chat id -> (chat id, message id) -> [link, text, reasons]
+        self._entries: dict[int, dict[tuple[int, int], list]] = {}
+        self._flusher = DelayedFlush(self._take, delay=interval)
+        self._logger = logging.getLogger(__name__)
+
+    def add(self, trash_id: int, key: tuple[int, int], link: str, text: str, reasons: list[str]):
+        """
+        Add the rejected message to the digest
+        :param trash_id: id of the Trash Bin chat
+        :param key: (chat id, message id) of the rejected message
+        :param link: link to the message
+        :param text: text of the message
+        :param reasons: why the message was rejected
+        """
+        entries = self._entries.setdefault(trash_id, {})
+        entry = entries.get(key)
+        if entry is not None:
+            entry[2].extend(reason for reason in reasons if reason not in entry[2])
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self.skipped += 1
+            return
+        self.added += 1
+        entries[key] = [link, text, list(dict.fromkeys(reasons))]
+        if len(entries) >= self.max_entries:
+            self._flusher.flush(trash_id)
+        else:
+            self._flusher.schedule(trash_id)
+
+    async def stop(self):
+        """
+        Post all the collected digests at once and wait for them
+        """
+        await self._flusher.stop(self._entries)
+
+    def render(self, entries: list[list]) -> list[str]:
+        """
+        :param entries: [link, text, reasons] of the rejected messages
+        :return: texts of the digest posts, each fits into one Telegram message
+        """
+        posts = []
+        post = f"Trash Bin: {len(entries)} messages\n"
+        for link, text, reasons in entries:
+            text = ' '.join((text or '').split())
+            if len(text) > self.preview_length:
+                text = text[:self.preview_length] + '…'
+            item = f"\n{link.strip()}\nreason: {'; '.join(' '.join(reason.split()) for reason in reasons)}\n{text}\n"
+            item = item[:MAX_MESSAGE_LENGTH]
+            if len(post) + len(item) > MAX_MESSAGE_LENGTH:
+                posts.append(post)
+                post = ''
+            post += item
+        if post.strip():
+            posts.append(post)
+        return posts
+
+    def _take(self, trash_id: int) -> Awaitable[Any] or None:
+        entries = self._entries.pop(trash_id, None)
+        return self._post(trash_id, list(entries.values())) if entries else None
+
+    async def _post(self, trash_id: int, entries: list[list]):
+        for post in self.render(entries):
+            try:
+                await self.send(trash_id, post)
+                self.posted += 1
+            except Exception as e:
+                self._logger.warning(f"Trash Bin digest of {len(entries)} messages wasn't posted: {str(e)}")
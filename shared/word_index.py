@@ -0,0 +1,194 @@
+# The words of the black, OR and AND lists and of the filters of all the rules are collected into one dictionary
+# when the rules are loaded. Each distinct pattern gets a word id. A message is scanned once against the whole
+# dictionary, and the result of the scan is the set of ids of the words found in the message. After that the
+# verdict of each rule is a set operation over the ids of its words, so the cost of matching a message doesn't
+# grow with the number of rules and keyword lists.
+#
+# The filters match whole words with fnmatch-style patterns (see filter_by_parameters.py), so a literal pattern
+# is found by a hash lookup of the words of the message, and only the patterns with the wildcard characters
+# '*', '?' and '[' fall back to regular expressions. All the wildcard patterns of a stream are translated once
+# into a single alternation, which finds the words matching any of them by one search over the joined words of
+# the message, and only these few words are then checked against each wildcard pattern.
+import fnmatch
+import functools
+import os
+import re
+from typing import Any
+
+# younotyou matches with fnmatch.fnmatch when case-insensitive matching is requested, and fnmatch only folds the
+# case on the platforms where os.path.normcase does it (Windows). Keep exactly the same behaviour.
+CASE_FOLDING = os.path.normcase('A') != 'A'
+
+# the streams of words of a message the patterns are matched against (see MessageText)
+TOKENS = 'tokens'   # raw words of the text, used by the filters
+WORDS = 'words'     # lowercased words without punctuation, used by the black, OR and AND lists
+
+
+def is_wildcard(pattern: str) -> bool:
+    return any(ch in pattern for ch in '*?[')
+
+
+def translate_word_pattern(pattern: str, word_char: str = r'\S') -> str:
+    """
+    Translate the fnmatch-style pattern into a regular expression matching one whole word inside the text of
+    space separated words. The same as fnmatch.translate, but the wildcards never match the spaces.
+    :param pattern: fnmatch-style pattern
+    :param word_char: regular expression of the characters the wildcards may match
+    :return: regular expression string
+    """
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            res.append(f'{word_char}*')
+        elif c == '?':
+            res.append(word_char)
+        elif c == '[':
+            # find the end of the set the same way fnmatch does
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                res.append(re.escape(c))
+            else:
+                # let fnmatch translate the set itself: '(?s:[...])\Z'
+                char_set = fnmatch.translate(pattern[i - 1:j + 1]).removeprefix('(?s:').removesuffix(')\\Z')
+                res.append(f'(?={word_char}){char_set}')
+                i = j + 1
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_alternation(patterns: tuple[str, ...], fold: bool) -> re.Pattern:
+    """
+    Compile the wildcard patterns into one regular expression matching the words of the joined text, which
+    match any of the patterns
+    :param patterns: fnmatch-style patterns
+    :param fold: the patterns and the text are folded with os.path.normcase (see CASE_FOLDING)
+    :return: compiled regular expression
+    """
+    if fold:
+        patterns = tuple(os.path.normcase(pattern) for pattern in patterns)
+    alternation = '|'.join(translate_word_pattern(pattern) for pattern in patterns)
+    return re.compile(rf'(?<!\S)(?=\S)(?:{alternation})(?!\S)')
+
+
+class WordIndex:
+    """
+    Dictionary of the patterns of all the rules: pattern -> word id
+    """
+    __slots__ = ("_ids", "_literals", "_wildcards", "_alternations")
+
+    def __init__(self):
+        self._ids: dict[tuple[str, str, bool], int] = {}
+        # (stream, fold) -> {literal: word id}
+        self._literals: dict[tuple[str, bool], dict[str, int]] = {}
+        # (stream, fold) -> [(compiled pattern, word id)]
+        self._wildcards: dict[tuple[str, bool], list[tuple[Any, int]]] = {}
+        # (stream, fold) -> alternation of all the wildcard patterns of the stream
+        self._alternations: dict[tuple[str, bool], re.Pattern] = {}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def copy(self) -> 'WordIndex':
+        """
+        :return: new index with the same word ids, the words added to it don't change this index
+        """
+        index = WordIndex()
+        index._ids = dict(self._ids)
+        index._literals = {key: dict(literals) for key, literals in self._literals.items()}
+        index._wildcards = {key: list(wildcards) for key, wildcards in self._wildcards.items()}
+        index._alternations = dict(self._alternations)
+        return index
+
+    def clear(self):
+        self._ids.clear()
+        self._literals.clear()
+        self._wildcards.clear()
+        self._alternations.clear()
+
+    def add(self, pattern: str, stream: str, case_sensitive: bool = True) -> int:
+        """
+        Register the pattern in the dictionary
+        :param pattern: fnmatch-style pattern
+        :param stream: TOKENS or WORDS
+        :param case_sensitive: the same meaning as the case_sensitive argument of younotyou
+        :return: word id of the pattern
+        """
+        fold = not case_sensitive and CASE_FOLDING
+        if fold:
+            pattern = os.path.normcase(pattern)
+        key = (pattern, stream, fold)
+        word_id = self._ids.get(key)
+        if word_id is None:
+            word_id = len(self._ids)
+            self._ids[key] = word_id
+            if is_wildcard(pattern):
+                match = re.compile(fnmatch.translate(pattern)).match
+                self._wildcards.setdefault((stream, fold), []).append((match, word_id))
+                self._alternations.pop((stream, fold), None)
+            else:
+                self._literals.setdefault((stream, fold), {})[pattern] = word_id
+        return word_id
+
+    def compile(self):
+        """
+        Compile the alternations of the wildcard patterns of all the streams. Call it when all the words are added,
+        so scan only reads the index and the first message doesn't wait for the compilation
+        """
+        for stream, fold in self._wildcards:
+            self._alternation(stream, fold)
+
+    def scan(self, text) -> set[int]:
+        """
+        Find all the registered patterns in the message
+        :param text: MessageText of the message
+        :return: set of word ids of the patterns found in the message
+        """
+        hits = set()
+        streams = set(self._literals) | set(self._wildcards)
+        for stream, fold in streams:
+            if stream == TOKENS:
+                words, word_set, joined = text.tokens, text.token_set, text.joined_tokens
+            else:
+                words, word_set, joined = text.words, text.word_set, text.joined_words
+            if fold:
+                words = [os.path.normcase(word) for word in words]
+                word_set = set(words)
+                joined = ' '.join(words)
+
+            literals = self._literals.get((stream, fold))
+            if literals:
+                # walk the smaller side
+                if len(literals) < len(word_set):
+                    hits.update(word_id for literal, word_id in literals.items() if literal in word_set)
+                else:
+                    hits.update(literals[word] for word in word_set if word in literals)
+
+            wildcards = self._wildcards.get((stream, fold))
+            if wildcards:
+                # one search over the joined words finds the words matching any of the wildcard patterns
+                matched_words = set(self._alternation(stream, fold).findall(joined))
+                for match, word_id in wildcards:
+                    for word in matched_words:
+                        if match(word):
+                            hits.add(word_id)
+                            break
+        return hits
+
+    def _alternation(self, stream: str, fold: bool) -> re.Pattern:
+        alternation = self._alternations.get((stream, fold))
+        if alternation is None:
+            patterns = tuple(sorted(pattern for pattern, word_stream, word_fold in self._ids
+                                    if word_stream == stream and word_fold == fold and is_wildcard(pattern)))
+            alternation = compile_alternation(patterns, fold)
+            self._alternations[(stream, fold)] = alternation
+        return alternation
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the client are imported from the root of the repository, as postclient.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,35 @@
+import asyncio
+
+from shared.delayed_flush import DelayedFlush
+
+
+def test_flushes_of_a_key_run_in_order_and_stop_waits_for_them():
+    written = []
+    buffers = {'a': [], 'b': []}
+
+    async def write(key, items, delay):
+        await asyncio.sleep(delay)
+        written.append((key, items))
+
+    def take(key):
+        items, buffers[key] = buffers[key], []
+        # the first flush of the key is the slowest one
+        return write(key, items, 0.05 if items == [1] else 0) if items else None
+
+    async def main():
+        flusher = DelayedFlush(take, delay=0.01)
+        buffers['a'].append(1)
+        flusher.flush('a')
+        buffers['a'].append(2)
+        flusher.flush('a')
+        buffers['b'].append(3)
+        flusher.schedule('b')
+        flusher.schedule('b')
+        await asyncio.sleep(0.02)
+        assert written == [('b', [3])]
+        buffers['b'].append(4)
+        await flusher.stop(buffers)
+
+    asyncio.run(main())
+    # the second flush of 'a' waits for the slow first one, 'b' doesn't wait for 'a'
+    assert written == [('b', [3]), ('b', [4]), ('a', [1]), ('a', [2])]
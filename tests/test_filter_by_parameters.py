@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+from shared.filter_by_parameters import RuleMatcher, MessageText, Censor, check_filter, check_black_list, \
+    check_or_list, check_for_and
+from shared.word_index import WordIndex
+
+VOCABULARY = ["list", "List", "LIST", "strings", "rings", "Any", "any", "tree", "pattern", "patterns",
+              "include_patterns", "every", "everything", "like", "test", "Test", "skip", "x", "y",
+              "word,", "word", "a-b", "42", "[ab]"]
+PATTERNS = VOCABULARY + ["*", "*rings", "*patt*", "every*", "Tes?", "?", "[lt]*", "*[!a]", "L*", "", "[", "a*b"]
+
+
+def random_case(rnd: random.Random) -> tuple[str, str, str]:
+    """
+    :return: random text, filter and word list
+    """
+    text = " ".join(rnd.choice(VOCABULARY) for _ in range(rnd.randint(0, 8)))
+    terms = []
+    for _ in range(rnd.randint(1, 4)):
+        term = rnd.choice(PATTERNS)
+        if rnd.random() < 0.25:
+            term = f"!{term}"
+        terms.append(term)
+    filter_text = terms[0]
+    for term in terms[1:]:
+        filter_text += rnd.choice([' | ', ' & '])
+        filter_text += term
+    word_list = rnd.choice(['|', '+']).join(rnd.choice(PATTERNS) for _ in range(rnd.randint(0, 3)))
+    return text, filter_text, word_list
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_compiled_matchers_agree_with_checks(seed):
+    rnd = random.Random(seed)
+    for _ in range(5000):
+        text, filter_text, word_list = random_case(rnd)
+        # a few rules share the same dictionary, so the ids of the other rules are found in the text too
+        index = WordIndex()
+        matcher = RuleMatcher(index, filter_text, word_list, word_list, word_list)
+        RuleMatcher(index, rnd.choice(PATTERNS), rnd.choice(PATTERNS), rnd.choice(PATTERNS), rnd.choice(PATTERNS))
+        hits = index.scan(MessageText(text))
+        case = f"text='{text}' filter='{filter_text}' list='{word_list}'"
+
+        assert matcher.check_filter(hits) == check_filter(text, filter_text), case
+        assert matcher.check_black_list(hits) == check_black_list(text, word_list), case
+        assert matcher.check_or_list(hits) == bool(check_or_list(text, word_list)), case
+        assert matcher.check_for_and(hits) == check_for_and(text, word_list), case
+        # a rule indexed by its required words may be skipped only if it doesn't accept the text anyway
+        if matcher.required is not None and matcher.required.isdisjoint(hits):
+            assert not (matcher.check_black_list(hits) and matcher.check_or_list(hits) and
+                        matcher.check_for_and(hits) and matcher.check_filter(hits)), case
+
+
+def test_censor_bleeps_words():
+    censor = Censor("bad|wor*|!worm", '*')
+    assert censor.bleep("Bad words, a worm and a badge") == ("*** *****, a worm and a badge", 2)
+
+
+def test_censor_ignores_wildcards_only():
+    assert Censor("*|**", '*').bleep("any text") == ("any text", 0)
+    assert Censor("*|bad", '*').bleep("a bad text") == ("a *** text", 1)
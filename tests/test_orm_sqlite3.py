@@ -0,0 +1,47 @@
+import asyncio
+import sqlite3
+
+from database.orm_sqlite3 import MIGRATIONS, BleepTable, Database, ImageTable, RulesTable, VersionTable
+
+
+def create_baseline(db_file: str):
+    """
+    The database of the client before the migrations: the image, rules and bleeping_rules tables only
+    """
+    with sqlite3.connect(db_file) as connection:
+        for table in (ImageTable(None), RulesTable(None), BleepTable(None)):
+            columns = [f"{name} INTEGER PRIMARY KEY AUTOINCREMENT" if name == 'uid' else name
+                       for name in table.__slots__]
+            connection.execute(f"CREATE TABLE {table.__table_name__}({', '.join(columns)})")
+        connection.execute("INSERT INTO rules (donor_id, recip_id, filter, status) "
+                           "VALUES (-1001, -200, 'w*', 'active')")
+        connection.execute("INSERT INTO image (file_id, path) VALUES ('id', './image.jpg')")
+    connection.close()
+
+
+def test_migrate_upgrades_the_baseline_database(tmp_path):
+    db_file = str(tmp_path / "baseline.db")
+    create_baseline(db_file)
+
+    async def main():
+        db = Database(db_file=db_file)
+        await db.create_tables()
+        # the second start finds the database up to date
+        applied = await db.migration_table.migrate(MIGRATIONS)
+        rules = await db.get_rules_table().get_rules()
+        await db.get_rules_table().update_rule(rules[0].uid, {"status": "pause"})
+        versions = await db.get_version_table().get_versions()
+        await db.disconnect()
+        return applied, rules, versions
+
+    applied, rules, versions = asyncio.run(main())
+    assert applied == []
+    assert [(rule.donor_id, rule.filter) for rule in rules] == [(-1001, 'w*')]
+    assert versions == {VersionTable.RULES: 1, VersionTable.BLEEPS: 0}
+    with sqlite3.connect(db_file) as connection:
+        assert connection.execute("SELECT version FROM schema_version ORDER BY version").fetchall() == [(1, ), (2, )]
+        names = {name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type IN ('index', "
+                                                      "'trigger')")}
+        assert {'rules_donor_id', 'bleeping_rules_status', 'rules_update_version'} <= names
+        assert connection.execute("SELECT file_id, path FROM image").fetchall() == [('id', './image.jpg')]
+    connection.close()
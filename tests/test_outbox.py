@@ -0,0 +1,62 @@
+import asyncio
+
+from database.orm_sqlite3 import Database
+from shared.outbox import Outbox
+
+
+def entry(msg_id: int, recip_id: int = -200) -> dict:
+    return {"donor_id": -1001, "msg_id": msg_id, "recip_id": recip_id, "message_ids": str(msg_id), "kind": "copy",
+            "header": ""}
+
+
+def run(test):
+    async def main():
+        db = Database()
+        await db.create_tables()
+        outbox = Outbox(db.get_outbox_table(), interval=0.01)
+        try:
+            await test(outbox)
+        finally:
+            await outbox.stop()
+            await db.disconnect()
+    asyncio.run(main())
+
+
+def test_the_same_delivery_is_queued_once():
+    async def test(outbox: Outbox):
+        assert await outbox.add([entry(1)]) == [True]
+        assert await outbox.add([entry(1)]) == [False]
+        # the same message for another recipient is another delivery
+        assert await outbox.add([entry(1, recip_id=-300)]) == [True]
+        # the duplicates added together
+        assert await outbox.add([entry(2), entry(2)]) == [True, False]
+        assert (outbox.added, outbox.duplicates) == (3, 2)
+
+    run(test)
+
+
+def test_pending_skips_the_deliveries_in_flight():
+    async def test(outbox: Outbox):
+        await outbox.add([entry(1), entry(2), entry(3)])
+        assert await outbox.pending() == []
+        outbox.done(-1001, 1, -200)
+        outbox.failed(-1001, 2, -200)
+        # the failed delivery is taken to send again, the taken one is in flight until it's done or failed
+        assert [pending.msg_id for pending in await outbox.pending()] == [2]
+        assert await outbox.pending() == []
+        outbox.failed(-1001, 2, -200)
+        assert [(pending.msg_id, pending.attempts) for pending in await outbox.pending()] == [(2, 2)]
+
+    run(test)
+
+
+def test_failed_delivery_isnt_sent_after_max_attempts():
+    async def test(outbox: Outbox):
+        outbox.max_attempts = 2
+        await outbox.add([entry(1)])
+        outbox.failed(-1001, 1, -200)
+        assert len(await outbox.pending()) == 1
+        outbox.failed(-1001, 1, -200)
+        assert await outbox.pending() == []
+
+    run(test)
@@ -0,0 +1,34 @@
+from database.orm_sqlite3 import RulesTable, BleepTable
+from shared.rule_snapshot import RuleSnapshot
+
+Rule = RulesTable(None).model_obj
+Bleep = BleepTable(None).model_obj
+
+
+def make_rules(first_uid: int = 1) -> list:
+    rules = [Rule(recip_id=-200, donor_id=-1001, filter=f'w{index} | x*', status='active', title='t',
+                  uid=first_uid + index) for index in range(5)]
+    rules.append(Rule(recip_id=-300, recip_name='tb', title='__trash_bin__', status='', uid=first_uid + 5))
+    return rules
+
+
+def test_trash_bin_status_survives_the_reload_of_the_bleeps():
+    snapshot = RuleSnapshot(make_rules()).with_trash_bin_status('active')
+    assert snapshot.with_bleeps([]).trash_bin.status == 'active'
+    assert snapshot.with_rules(snapshot.all_rules).trash_bin.status == 'active'
+
+
+def test_imported_rules_reuse_the_matchers():
+    snapshot = RuleSnapshot(make_rules())
+    # the import stores all the rules anew, with the new uids
+    imported = snapshot.with_rules(make_rules(first_uid=11))
+    assert (imported.compiled, imported.reused) == (0, 5)
+    changed = imported.with_rules(make_rules(first_uid=21)[:4] + [Rule(recip_id=-200, donor_id=-1001, filter='new',
+                                                                       status='active', uid=30)])
+    assert (changed.compiled, changed.reused) == (1, 4)
+
+
+def test_bleeps_reuse_the_censors():
+    snapshot = RuleSnapshot((), [Bleep(donor_id=-1, black_list='bad', bleep_symbol='*', uid=1)])
+    reloaded = snapshot.with_bleeps([Bleep(donor_id=-1, black_list='bad', bleep_symbol='*', uid=2)])
+    assert reloaded.bleep_censors[2] is snapshot.bleep_censors[1]
@@ -0,0 +1,74 @@
+import asyncio
+import csv
+import io
+import types
+
+from database.orm_sqlite3 import Database
+from database.rules_io import END_OF_RULES, cmd_import_rules, iter_csv_rows
+
+ROWS = [
+    ["donor_name", "donor_id", "black_list", "status", "bleep_symbol", "bleep_actions", "action_format"],
+    ["Новости 📰", "-1001", "слово | word*", "active", "*", "", ""],
+    ["multi\nline", "-1002", 'say "hi"\nand\r\nbye', "active", "#", "", "ü"],
+    [END_OF_RULES],
+]
+
+
+def to_csv(rows: list[list[str]], lineterminator: str = '\n') -> bytes:
+    text = io.StringIO()
+    csv.writer(text, lineterminator=lineterminator).writerows(rows)
+    return text.getvalue().encode('utf8')
+
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def parse(data: bytes, size: int) -> list[list[str]]:
+    async def collect():
+        return [row async for row in iter_csv_rows(chunked(data, size))]
+    return asyncio.run(collect())
+
+
+def test_rows_dont_depend_on_the_chunk_boundaries():
+    data = to_csv(ROWS)
+    # the boundaries fall inside the multi-byte characters and inside the quoted line breaks
+    for size in range(1, len(data) + 1):
+        assert parse(data, size) == ROWS, size
+
+
+def test_crlf_lines_and_the_missing_last_line_break():
+    data = to_csv(ROWS, lineterminator='\r\n')
+    for size in (1, 2, 3, 7, len(data)):
+        assert parse(data, size) == ROWS
+        assert parse(data.rstrip(b'\r\n'), size) == ROWS
+
+
+def test_bom_is_dropped():
+    data = b'\xef\xbb\xbf' + to_csv(ROWS)
+    for size in (1, 2, 4, len(data)):
+        assert parse(data, size)[0][0] == "donor_name"
+
+
+def test_import_stops_at_the_end_of_rules_row():
+    rows = ROWS + [["after", "-1003", "x", "active", "*", "", ""]]
+    messages = []
+
+    async def send_message(chat_id, text):
+        messages.append(text)
+
+    async def main():
+        db = Database()
+        await db.create_tables()
+        tg_client = types.SimpleNamespace(iter_download=lambda document: chunked(to_csv(rows), 5))
+        scheduler = types.SimpleNamespace(send_message=send_message)
+        assert await cmd_import_rules(db, tg_client, scheduler, None)
+        imported = await db.get_bleep_table().get_rules()
+        await db.disconnect()
+        return imported
+
+    imported = asyncio.run(main())
+    assert [rule.donor_id for rule in imported] == [-1001, -1002]
+    assert imported[1].black_list == 'say "hi"\nand\r\nbye'
+    assert messages[0].startswith('2 bleep rules was found')
@@ -0,0 +1,38 @@
+import random
+
+from younotyou import younotyou as flt
+
+from shared.filter_by_parameters import MessageText
+from shared.word_index import WordIndex, TOKENS
+
+
+def test_wildcards_agree_with_younotyou():
+    rnd = random.Random(0)
+    syllables = ["pat", "tern", "str", "ing", "list", "tree", "ev", "ery", "any", "thing", "lo", "rem"]
+    words = [''.join(rnd.choice(syllables) for _ in range(rnd.randint(1, 3))) for _ in range(500)]
+    rule_patterns = []
+    for _ in range(200):
+        patterns = []
+        for _ in range(rnd.randint(1, 4)):
+            word = rnd.choice(words)
+            patterns.append(rnd.choice([f'*{word}', f'{word}*', f'*{word}*', f'{word[:-1]}?']))
+        rule_patterns.append(patterns)
+
+    # the patterns of all the rules are matched by one scan of the text
+    index = WordIndex()
+    rule_ids = [frozenset(index.add(pattern, TOKENS) for pattern in patterns) for patterns in rule_patterns]
+    for _ in range(300):
+        text = ' '.join(rnd.choice(words) for _ in range(rnd.randint(5, 60)))
+        hits = index.scan(MessageText(text))
+        expected = [len(flt(text.split(), patterns)) > 0 for patterns in rule_patterns]
+        assert [not ids.isdisjoint(hits) for ids in rule_ids] == expected, text
+
+
+def test_compiled_index_isnt_changed_by_scan():
+    index = WordIndex()
+    word_id = index.add('*ing', TOKENS)
+    index.add('tree', TOKENS)
+    index.compile()
+    alternations = dict(index._alternations)
+    assert index.scan(MessageText("a string tree")) == {word_id, word_id + 1}
+    assert alternations and index._alternations == alternations